@@ -0,0 +1,143 @@
+import asyncio
+import os
+from collections import deque
+
+
+class AdmissionError(Exception):
+    """请求未被接纳，``status_code`` 为建议返回的 HTTP 状态码"""
+
+    def __init__(self, message: str, status_code: int, retry_after: int | None = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class PixelBudget:
+    """按图片像素数控制同时处理的请求
+
+    所有在处理中的图片像素总数不超过 ``budget``，超出时按到达顺序排队，
+    最多等待 ``max_wait`` 秒 (超时返回 503)；排队数超过 ``max_queue`` 时
+    直接拒绝 (429)。单张图片超过 ``max_pixels`` 时拒绝 (413)。
+    ``budget`` 或 ``max_pixels`` 为 0 表示不限制。
+    """
+
+    def __init__(
+        self,
+        budget: int = 0,
+        max_pixels: int = 0,
+        max_wait: float = 10,
+        max_queue: int = 32,
+    ):
+        self.budget = budget
+        self.max_pixels = max_pixels
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.in_use = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.too_large = 0
+        self._waiters: deque[tuple[int, asyncio.Future]] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _wake(self) -> None:
+        """按顺序放行排在队首、预算足够的请求"""
+        while self._waiters:
+            cost, future = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+            if self.in_use + cost > self.budget:
+                break
+            self._waiters.popleft()
+            self.in_use += cost
+            future.set_result(None)
+
+    def check(self, pixels: int) -> None:
+        """单张图片超过像素上限时抛出 AdmissionError"""
+        if self.max_pixels > 0 and pixels > self.max_pixels:
+            self.too_large += 1
+            raise AdmissionError(
+                f"图片像素数 {pixels} 超过上限 {self.max_pixels}", status_code=413
+            )
+
+    async def acquire(
+        self, pixels: int, timeout: float | None = -1, count: int = 1, extra: int = 0
+    ) -> int:
+        """占用预算，返回实际占用的像素数 (需要传给 release)
+
+        ``timeout`` 为 -1 时使用 ``max_wait``；为 None 时一直等待且不受排队数
+        限制，用于任务队列、批量处理等自身已限制并发的调用方。``count`` 为
+        同时在内存中的同尺寸图片数 (如视频的缓存帧)，单张上限只按一张检查。
+        ``extra`` 为额外占用的像素数 (如视频对象的裁剪帧)，不参与单张上限检查。
+        """
+        self.check(pixels)
+        if self.budget <= 0:
+            self.admitted += 1
+            return 0
+        # 超过总预算的请求在没有其他请求时独占预算
+        cost = min(pixels * count + extra, self.budget)
+        if not self._waiters and self.in_use + cost <= self.budget:
+            self.in_use += cost
+            self.admitted += 1
+            return cost
+        if timeout is not None and len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionError("服务繁忙，请稍后重试", status_code=429, retry_after=1)
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (cost, future)
+        self._waiters.append(entry)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(future, self.max_wait if timeout == -1 else timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # 放弃等待的同时恰好被放行
+                self.release(cost)
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                self._wake()
+            if isinstance(e, TimeoutError):
+                self.timeouts += 1
+                raise AdmissionError(
+                    "等待处理超时，请稍后重试", status_code=503, retry_after=1
+                )
+            raise
+        self.admitted += 1
+        return cost
+
+    def release(self, cost: int) -> None:
+        if cost:
+            self.in_use -= cost
+            self._wake()
+
+    def stats(self) -> dict:
+        return {
+            "budget": self.budget,
+            "max_pixels": self.max_pixels,
+            "in_use": self.in_use,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "too_large": self.too_large,
+        }
+
+
+def from_env() -> PixelBudget:
+    """由环境变量创建像素预算，像素数以百万像素为单位配置"""
+    return PixelBudget(
+        budget=int(float(os.getenv("PIXEL_BUDGET_MP", 400)) * 1_000_000),
+        max_pixels=int(float(os.getenv("MAX_IMAGE_MP", 100)) * 1_000_000),
+        max_wait=float(os.getenv("ADMISSION_MAX_WAIT", 10)),
+        max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", 32)),
+    )
+
+
+pixel_budget = from_env()
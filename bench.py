@@ -0,0 +1,516 @@
+"""性能基准测试
+
+直接调用 gen.square / mask / highlight，或通过 HTTP 接口压测 FastAPI 应用，
+统计吞吐量、p50/p95/p99 延迟和峰值内存，结果写入 JSON 文件。
+
+    python bench.py gen --sizes 640,1920,3840 --densities 1,4,16
+    python bench.py api --concurrency 1,8 --requests 50
+    python bench.py all --offline --onnx-threads 4
+
+使用真实模型时需要本地已有模型缓存 (--offline 禁止联网下载)；
+--stub-detector 用合成图片中已知的对象位置代替模型，只测量解码、裁剪、绘制和编码。
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+# 桩检测器为 NudeNet 的每个派生类型都返回一组对象
+NUDENET_LABELS = [
+    "FEMALE_GENITALIA_EXPOSED",
+    "FEMALE_BREAST_EXPOSED",
+    "ARMPITS_EXPOSED",
+    "FEET_EXPOSED",
+]
+
+
+def synthetic_image(
+    long_side: int, density: int, seed: int = 0
+) -> tuple[bytes, list[tuple[int, int, int, int]]]:
+    """生成带有 ``density`` 个椭圆对象的 4:3 测试图片
+
+    Returns:
+        (JPEG 编码的图片, 对象的外接框列表)
+    """
+    width, height = long_side, long_side * 3 // 4
+    rng = np.random.default_rng(seed)
+    # 低频色块加少量噪声，使编码开销接近真实图片
+    base = rng.integers(0, 256, (max(2, height // 64), max(2, width // 64), 3))
+    image = Image.fromarray(base.astype(np.uint8)).resize(
+        (width, height), Image.Resampling.BICUBIC
+    )
+    noise = rng.integers(-12, 13, (height, width, 3))
+    image = Image.fromarray(
+        np.clip(np.asarray(image, dtype=np.int16) + noise, 0, 255).astype(np.uint8)
+    )
+
+    draw = ImageDraw.Draw(image)
+    cols = math.ceil(math.sqrt(density))
+    rows = math.ceil(density / cols)
+    cell_w, cell_h = width / cols, height / rows
+    boxes = []
+    for i in range(density):
+        row, col = divmod(i, cols)
+        cx, cy = (col + 0.5) * cell_w, (row + 0.5) * cell_h
+        radius = min(cell_w, cell_h) * 0.3
+        box = (
+            int(cx - radius),
+            int(cy - radius * 1.2),
+            int(cx + radius),
+            int(cy + radius * 1.2),
+        )
+        color = tuple(int(v) for v in rng.integers(0, 256, 3))
+        draw.ellipse(box, fill=color, outline=(0, 0, 0), width=3)
+        boxes.append(box)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue(), boxes
+
+
+class Fixtures:
+    """按 (长边, 对象数量) 缓存的测试图片，并为桩检测器提供对象位置"""
+
+    def __init__(self):
+        self.images: dict[tuple[int, int], tuple[bytes, list]] = {}
+        self.boxes: dict[str, tuple[tuple[int, int], list]] = {}
+
+    def get(self, long_side: int, density: int) -> tuple[bytes, list]:
+        import cache
+
+        key = (long_side, density)
+        if key not in self.images:
+            content, boxes = synthetic_image(long_side, density, seed=len(self.images))
+            self.images[key] = (content, boxes)
+            size = Image.open(io.BytesIO(content)).size
+            self.boxes[cache.content_digest(content)] = (size, boxes)
+        return self.images[key]
+
+    def stub(self, labels: list[str]) -> Callable:
+        """返回按图片内容哈希查找对象位置的桩检测器"""
+        import cache
+
+        def detector(image: Image.Image):
+            digest = cache.image_digest(image).split("@")[0]
+            (width, height), boxes = self.boxes.get(digest, ((1, 1), []))
+            sx, sy = image.width / width, image.height / height
+            return [
+                (
+                    (round(x0 * sx), round(y0 * sy), round(x1 * sx), round(y1 * sy)),
+                    label,
+                    0.9,
+                )
+                for label in labels
+                for x0, y0, x1, y1 in boxes
+            ]
+
+        return detector
+
+
+def install_stub(fixtures: Fixtures) -> None:
+    import gen
+
+    labels = {
+        gen.GenSquareType.HEAD: ["head"],
+        gen.GenSquareType.EYES: ["eye"],
+        gen.GenSquareType.FACES: ["face"],
+        gen.GenSquareType.CENSORS: ["nipple_f"],
+        gen.GenSquareType.NUDENET: NUDENET_LABELS,
+    }
+    for source, source_labels in labels.items():
+        gen.detector[source] = fixtures.stub(source_labels)
+
+
+def summarize(latencies: list[float], wall: float) -> dict:
+    """延迟 (秒) 列表转换为吞吐量和分位数 (毫秒)"""
+    ms = np.array(latencies) * 1000
+    return {
+        "runs": len(latencies),
+        "throughput": round(len(latencies) / wall, 3) if wall > 0 else None,
+        "mean_ms": round(float(ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+    }
+
+
+def reset_peak_rss() -> bool:
+    """重置本进程的峰值常驻内存 (VmHWM)，只支持 Linux，返回是否成功"""
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def case_peak_rss_mb(reset: bool) -> float | None:
+    """上次重置以来本进程的峰值常驻内存，未能重置时返回 None
+
+    ``ru_maxrss`` 是整个进程生命周期的峰值，之后的每一项都会沿用最重一项的
+    数值，因此逐项测量读取重置后的 VmHWM。
+    """
+    if not reset:
+        return None
+    with open("/proc/self/status") as file:
+        for line in file:
+            if line.startswith("VmHWM:"):
+                return round(int(line.split()[1]) / 1024, 1)
+    return None
+
+
+def peak_rss_mb() -> dict:
+    """本进程和已结束子进程 (如工作进程) 在整个运行期间的峰值常驻内存"""
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        "children": round(
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1
+        ),
+    }
+
+
+def bench_gen(args, fixtures: Fixtures) -> list[dict]:
+    """直接调用 gen 的生成函数，检测结果使用合成图片中的对象位置"""
+    import gen
+    import utils
+
+    rows = []
+    for long_side in args.sizes:
+        for density in args.densities:
+            content, boxes = fixtures.get(long_side, density)
+            results = [(box, "object", 0.9) for box in boxes]
+            if not args.stub_detector:
+                for source in gen.group_types(args.types):
+                    image = utils.open_image(content)
+                    image.load()
+                    latencies = []
+                    reset = reset_peak_rss()
+                    started = time.perf_counter()
+                    for _ in range(args.repeat):
+                        run_started = time.perf_counter()
+                        detections = gen.detector[source](image)
+                        latencies.append(time.perf_counter() - run_started)
+                    rows.append(
+                        {
+                            "suite": "gen",
+                            "function": "detect",
+                            "type": source,
+                            "size": long_side,
+                            "density": density,
+                            "detections": len(detections or []),
+                            **summarize(latencies, time.perf_counter() - started),
+                            "peak_rss_mb": case_peak_rss_mb(reset),
+                        }
+                    )
+            for kind in args.functions:
+                for type in args.types:
+                    latencies = []
+                    reset = reset_peak_rss()
+                    started = time.perf_counter()
+                    for _ in range(args.repeat):
+                        run_started = time.perf_counter()
+                        # 每次重新打开图片，计入解码开销 (mask 会在原图上绘制)
+                        image = utils.open_image(content)
+                        output = gen.generators[kind](
+                            type=type,
+                            image=image,
+                            results=results,
+                            **(
+                                {"target_size": args.target_size}
+                                if kind == "square"
+                                else {}
+                            ),
+                        )
+                        latencies.append(time.perf_counter() - run_started)
+                    rows.append(
+                        {
+                            "suite": "gen",
+                            "function": kind,
+                            "type": type,
+                            "size": long_side,
+                            "density": density,
+                            "output_bytes": sum(map(len, output))
+                            if isinstance(output, list)
+                            else len(output or b""),
+                            **summarize(latencies, time.perf_counter() - started),
+                            "peak_rss_mb": case_peak_rss_mb(reset),
+                        }
+                    )
+                    print(_describe(rows[-1]), file=sys.stderr)
+    return rows
+
+
+async def _drive(
+    client, endpoint: str, data: dict, content: bytes, requests: int, concurrency: int
+) -> tuple[list[float], dict[int, int]]:
+    """以 ``concurrency`` 并发发送 ``requests`` 个请求，返回延迟和状态码计数"""
+    latencies: list[float] = []
+    statuses: dict[int, int] = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {}
+    if os.getenv("API_KEY"):
+        headers["Authorization"] = f"Bearer {os.environ['API_KEY']}"
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post(
+                f"/{endpoint}",
+                files={"file": ("bench.jpg", content, "image/jpeg")},
+                data=data,
+                headers=headers,
+            )
+            await response.aread()
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    await asyncio.gather(*(one() for _ in range(requests)))
+    return latencies, statuses
+
+
+def bench_api(args, fixtures: Fixtures) -> list[dict]:
+    """以指定并发度压测 HTTP 接口，未指定 --url 时在进程内驱动应用"""
+    import httpx
+
+    if args.url:
+        transport = None
+        base_url = args.url.rstrip("/")
+    else:
+        import main
+
+        transport = httpx.ASGITransport(app=main.app)
+        base_url = "http://bench"
+
+    async def run() -> list[dict]:
+        rows = []
+        async with httpx.AsyncClient(
+            transport=transport, base_url=base_url, timeout=args.timeout
+        ) as client:
+            for endpoint in args.endpoints:
+                for type in args.types:
+                    data = (
+                        {"types": str(type)}
+                        if endpoint in ("detect", "cutmany")
+                        else {"type": str(type)}
+                    )
+                    for long_side in args.sizes:
+                        for density in args.densities:
+                            content, _ = fixtures.get(long_side, density)
+                            for concurrency in args.concurrency:
+                                reset = reset_peak_rss()
+                                started = time.perf_counter()
+                                latencies, statuses = await _drive(
+                                    client,
+                                    endpoint,
+                                    data,
+                                    content,
+                                    args.requests,
+                                    concurrency,
+                                )
+                                rows.append(
+                                    {
+                                        "suite": "api",
+                                        "endpoint": endpoint,
+                                        "type": str(type),
+                                        "size": long_side,
+                                        "density": density,
+                                        "concurrency": concurrency,
+                                        "status": {
+                                            str(code): count
+                                            for code, count in statuses.items()
+                                        },
+                                        **summarize(
+                                            latencies, time.perf_counter() - started
+                                        ),
+                                        "peak_rss_mb": case_peak_rss_mb(reset),
+                                    }
+                                )
+                                print(_describe(rows[-1]), file=sys.stderr)
+        return rows
+
+    return asyncio.run(run())
+
+
+def _describe(row: dict) -> str:
+    target = row.get("endpoint") or row["function"]
+    extra = f" c={row['concurrency']}" if "concurrency" in row else ""
+    return (
+        f"{row['suite']:>3} {target:<10} {row['type']:<8} {row['size']:>5}px "
+        f"n={row['density']:<3}{extra} {row['throughput']:>8}/s "
+        f"p50={row['p50_ms']:.1f}ms p95={row['p95_ms']:.1f}ms p99={row['p99_ms']:.1f}ms"
+    )
+
+
+def metadata(args) -> dict:
+    from importlib import metadata as package_metadata
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    versions = {}
+    for package in ("dghs-imgutils", "onnxruntime", "pillow", "numpy", "fastapi"):
+        try:
+            versions[package] = package_metadata.version(package)
+        except package_metadata.PackageNotFoundError:
+            versions[package] = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "versions": versions,
+        "args": {
+            name: value
+            if isinstance(value, (int, float, str, bool, type(None)))
+            else [str(v) for v in value]
+            for name, value in vars(args).items()
+        },
+        "env": {
+            name: os.getenv(name)
+            for name in (
+                "MAX_DETECT_SIDE",
+                "CROP_THREADS",
+                "DETECT_CACHE_SIZE",
+                "NEAR_DUP_SIZE",
+                "INFERENCE_SCHEDULER",
+                "WORKER_PROCESSES",
+                "WORKER_ONNX_THREADS",
+                "RESULT_BACKEND",
+                "HF_HUB_OFFLINE",
+            )
+        },
+    }
+
+
+def _ints(value: str) -> list[int]:
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+def _names(value: str) -> list[str]:
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Cut Avatar API 性能基准测试")
+    parser.add_argument("suite", choices=["gen", "api", "all"], help="测试套件")
+    parser.add_argument(
+        "--types",
+        type=_names,
+        default=None,
+        help="逗号分隔的对象类型，默认全部",
+    )
+    parser.add_argument(
+        "--sizes", type=_ints, default=[640, 1920, 3840], help="图片长边"
+    )
+    parser.add_argument(
+        "--densities", type=_ints, default=[1, 4, 16], help="每张图片的对象数量"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="gen 套件每个用例的执行次数"
+    )
+    parser.add_argument(
+        "--functions",
+        type=_names,
+        default=["square", "mask", "highlight"],
+        help="gen 套件测试的生成函数",
+    )
+    parser.add_argument(
+        "--target-size", type=int, default=640, help="square 的输出边长"
+    )
+    parser.add_argument(
+        "--endpoints",
+        type=_names,
+        default=["cutone", "cutall", "mask", "highlight", "detect"],
+        help="api 套件测试的接口",
+    )
+    parser.add_argument(
+        "--concurrency", type=_ints, default=[1, 8], help="api 套件的并发度"
+    )
+    parser.add_argument(
+        "--requests", type=int, default=20, help="api 套件每个用例的请求数"
+    )
+    parser.add_argument(
+        "--url", default="", help="压测已运行的服务，默认在进程内驱动应用"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=300, help="单个请求的超时 (秒)"
+    )
+    parser.add_argument(
+        "--stub-detector", action="store_true", help="不运行模型，使用合成对象位置"
+    )
+    parser.add_argument("--offline", action="store_true", help="只使用本地模型缓存")
+    parser.add_argument(
+        "--onnx-threads", type=int, default=0, help="ONNX intra-op 线程数 (0 表示默认)"
+    )
+    parser.add_argument(
+        "--cache", action="store_true", help="启用检测结果缓存和近似重复索引 (默认关闭)"
+    )
+    parser.add_argument("--output", default="bench_results.json", help="结果文件")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    # 以下环境变量需在导入 imgutils 和服务模块之前设置
+    if args.offline:
+        os.environ["HF_HUB_OFFLINE"] = "1"
+    if not args.cache:
+        os.environ["DETECT_CACHE_SIZE"] = "0"
+        os.environ["NEAR_DUP_SIZE"] = "0"
+    os.environ.setdefault("RESULT_BACKEND", "memory")
+
+    from loguru import logger
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    import gen
+    import utils
+
+    args.types = [
+        gen.GenSquareType(name) for name in args.types or list(gen.GenSquareType)
+    ]
+    if args.onnx_threads > 0:
+        utils.limit_onnx_threads(args.onnx_threads)
+    fixtures = Fixtures()
+    if args.stub_detector:
+        install_stub(fixtures)
+    elif not args.url:
+        gen.warm_up(args.types)
+
+    rows = []
+    if args.suite in ("gen", "all"):
+        rows += bench_gen(args, fixtures)
+    if args.suite in ("api", "all"):
+        rows += bench_api(args, fixtures)
+
+    # 先取峰值内存，metadata 中启动的 git 子进程会计入子进程内存
+    peak = peak_rss_mb()
+    report = {"meta": metadata(args), "results": rows, "peak_rss_mb": peak}
+    Path(args.output).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    print(f"结果已写入 {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+from loguru import logger
+from PIL import Image
+
+from detect import Detection
+
+
+def content_digest(content: bytes) -> str:
+    """计算上传内容的哈希"""
+    return hashlib.sha256(content).hexdigest()
+
+
+def image_digest(image: Image.Image) -> str:
+    """获取图片的内容哈希
+
+    优先使用解码时记录的上传内容哈希 (见 utils.open_image)，
+    否则退回到对像素数据取哈希。
+    """
+    digest = image.info.get("digest")
+    if digest:
+        return digest
+    hasher = hashlib.sha256(f"{image.mode}:{image.size}:".encode())
+    hasher.update(image.tobytes())
+    return hasher.hexdigest()
+
+
+def make_key(model: str, digest: str) -> str:
+    """由模型标识和图片哈希生成缓存键"""
+    return hashlib.sha256(f"{model}:{digest}".encode()).hexdigest()
+
+
+class DetectionCache:
+    """检测结果缓存，内存 LRU 层 + 可选的磁盘层"""
+
+    def __init__(self, max_entries: int = 256, cache_dir: Path | None = None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, list[Detection]] = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir is not None and not cache_dir.exists():
+            cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _disk_path(self, key: str) -> Path:
+        assert self.cache_dir is not None
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def _remember(self, key: str, results: list[Detection]) -> None:
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = results
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _load(self, key: str) -> list[Detection] | None:
+        if self.cache_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            data = json.loads(path.read_text())
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"读取检测缓存失败: {str(e)}")
+            return None
+        return [(tuple(box), label, score) for box, label, score in data]
+
+    def _store(self, key: str, results: list[Detection]) -> None:
+        if self.cache_dir is None:
+            return
+        path = self._disk_path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp_path.write_text(
+                json.dumps([[list(box), label, score] for box, label, score in results])
+            )
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f"写入检测缓存失败: {str(e)}")
+
+    def get(self, key: str) -> list[Detection] | None:
+        """查询缓存，未命中时返回 None (空列表表示已缓存的 "无检测结果")"""
+        with self._lock:
+            results = self._entries.get(key)
+            if results is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return results
+        results = self._load(key)
+        with self._lock:
+            if results is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, results)
+        return results
+
+    def put(self, key: str, results: list[Detection]) -> None:
+        results = [
+            (tuple(int(v) for v in box), str(label), float(score))
+            for box, label, score in results
+        ]
+        with self._lock:
+            self._remember(key, results)
+        self._store(key, results)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "disk": str(self.cache_dir) if self.cache_dir else None,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class Signature:
+    """图片的感知哈希 (64 位 dHash) 和用于复核的灰度缩略图"""
+
+    THUMB_SIZE = 32
+
+    def __init__(self, image: Image.Image):
+        # 先用 reducing_gap 快速缩小再转灰度，避免对大图整幅转换
+        gray = image.resize(
+            (self.THUMB_SIZE * 2, self.THUMB_SIZE * 2),
+            Image.Resampling.BOX,
+            reducing_gap=2.0,
+        ).convert("L")
+        pixels = np.asarray(gray.resize((9, 8), Image.Resampling.BOX), dtype=np.int16)
+        bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+        self.hash = int("".join("1" if bit else "0" for bit in bits), 2)
+        self.thumb = np.asarray(
+            gray.resize((self.THUMB_SIZE, self.THUMB_SIZE), Image.Resampling.BOX),
+            dtype=np.int16,
+        )
+        self.size = image.size
+
+
+class NearDuplicateIndex:
+    """按感知哈希查找近似重复图片的检测结果
+
+    重新压缩或缩放后的图片内容哈希不同，但 dHash 的汉明距离很小。哈希按
+    ``max_distance + 1`` 段建立多重索引 (距离不超过阈值的两个哈希至少有一段
+    完全相同)，候选结果还需宽高比一致、缩略图平均灰度差不超过 ``max_diff``
+    才会复用，检测框由调用方按尺寸缩放。
+    """
+
+    def __init__(
+        self, max_entries: int = 1024, max_distance: int = 6, max_diff: float = 5.0
+    ):
+        self.max_entries = max_entries
+        self.max_distance = max(0, min(max_distance, 63))
+        self.max_diff = max_diff
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self.evictions = 0
+        blocks = self.max_distance + 1
+        bounds = [64 * i // blocks for i in range(blocks + 1)]
+        self._blocks = [
+            (start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])
+        ]
+        self._entries: OrderedDict[int, tuple[str, Signature, list[Detection]]] = (
+            OrderedDict()
+        )
+        self._index: dict[tuple[str, int, int], set[int]] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def _keys(self, model: str, hash: int) -> list[tuple[str, int, int]]:
+        return [
+            (model, i, (hash >> start) & mask)
+            for i, (start, mask) in enumerate(self._blocks)
+        ]
+
+    def lookup(
+        self, model: str, signature: Signature
+    ) -> tuple[list[Detection], tuple[int, int]] | None:
+        """查找近似重复图片，返回 (检测结果, 该结果对应的图片尺寸)"""
+        with self._lock:
+            candidates: set[int] = set()
+            for key in self._keys(model, signature.hash):
+                candidates |= self._index.get(key, set())
+            best: tuple[int, int] | None = None
+            for id in candidates:
+                distance = (self._entries[id][1].hash ^ signature.hash).bit_count()
+                if distance <= self.max_distance and (
+                    best is None or distance < best[0]
+                ):
+                    best = (distance, id)
+            if best is None:
+                self.misses += 1
+                return None
+            distance, id = best
+            _, stored, results = self._entries[id]
+            width, height = signature.size
+            stored_width, stored_height = stored.size
+            same_aspect = (
+                abs(width * stored_height - height * stored_width)
+                <= 0.01 * width * stored_height
+            )
+            diff = float(np.abs(stored.thumb - signature.thumb).mean())
+            if not same_aspect or diff > self.max_diff:
+                self.rejected += 1
+                return None
+            self._entries.move_to_end(id)
+            self.hits += 1
+        logger.info(
+            f"近似重复图片命中，复用 {model} 的检测结果: 尺寸 {stored_width}x{stored_height}"
+            f" -> {width}x{height}，汉明距离 {distance}，缩略图差异 {diff:.2f}"
+        )
+        return results, stored.size
+
+    def add(self, model: str, signature: Signature, results: list[Detection]) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            id = self._next_id
+            self._next_id += 1
+            self._entries[id] = (model, signature, results)
+            for key in self._keys(model, signature.hash):
+                self._index.setdefault(key, set()).add(id)
+            while len(self._entries) > self.max_entries:
+                old_id, (old_model, old, _) = self._entries.popitem(last=False)
+                for key in self._keys(old_model, old.hash):
+                    ids = self._index[key]
+                    ids.discard(old_id)
+                    if not ids:
+                        del self._index[key]
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses + self.rejected
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "max_distance": self.max_distance,
+                "hits": self.hits,
+                "misses": self.misses,
+                "rejected": self.rejected,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+detection_cache = DetectionCache(
+    max_entries=int(os.getenv("DETECT_CACHE_SIZE", 256)),
+    cache_dir=Path(os.environ["DETECT_CACHE_DIR"])
+    if os.getenv("DETECT_CACHE_DIR")
+    else None,
+)
+near_duplicates = NearDuplicateIndex(
+    # 近似图片复用其他图片的检测结果，默认关闭
+    max_entries=int(os.getenv("NEAR_DUP_SIZE", 0)),
+    max_distance=int(os.getenv("NEAR_DUP_DISTANCE", 6)),
+    max_diff=float(os.getenv("NEAR_DUP_MAX_DIFF", 5.0)),
+)
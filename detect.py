@@ -1,47 +1,125 @@
-from pathlib import Path
+import os
+from collections.abc import Callable, Iterator
+
 from imgutils import detect
+from imgutils.data import ImageTyping
+from PIL import Image
+
+import geometry
+from geometry import Detection
+
+# 分块检测的块边长，长边超过 1.5 倍时启用 (0 表示不启用)
+TILE_SIZE = int(os.getenv("TILE_SIZE", 0))
+# 相邻块的重叠比例
+TILE_OVERLAP = float(os.getenv("TILE_OVERLAP", 0.25))
+
+
+def tile_windows(
+    size: tuple[int, int], tile_size: int, overlap: float = TILE_OVERLAP
+) -> Iterator[tuple[int, int, int, int]]:
+    """按块边长和重叠比例产出覆盖整张图片的分块区域，最后一块贴齐图片边缘"""
+    width, height = size
+    stride = max(1, int(tile_size * (1 - overlap)))
+
+    def starts(length: int) -> list[int]:
+        if length <= tile_size:
+            return [0]
+        positions = list(range(0, length - tile_size, stride))
+        return positions + [length - tile_size]
+
+    for top in starts(height):
+        for left in starts(width):
+            yield (
+                left,
+                top,
+                min(width, left + tile_size),
+                min(height, top + tile_size),
+            )
+
+
+def needs_tiling(size: tuple[int, int], tile_size: int = TILE_SIZE) -> bool:
+    return tile_size > 0 and max(size) > tile_size * 1.5
+
+
+def tiled(
+    detector: Callable[[ImageTyping], list[Detection] | None],
+    image: Image.Image,
+    tile_size: int = TILE_SIZE,
+    overlap: float = TILE_OVERLAP,
+) -> list[Detection] | None:
+    """分块检测，适合长条漫画、全景图等超大图片
+
+    重叠的分块依次检测 (imgutils 按线程缓存 ONNX 会话，并发检测分块需要每个
+    线程各加载一份模型，还会同时保留多个分块副本)，每块在检测前才从已解码的
+    原图裁出，同时只存在一个分块副本。贴着块内部边缘的框视为被截断并丢弃
+    (完整的对象会出现在相邻块中)，另外在整图上检测一次以保留比块更大的
+    对象，最后用 NMS 合并。
+    """
+    image.load()
+    width, height = image.size
+
+    def run(window: tuple[int, int, int, int]) -> list[Detection]:
+        left, top, right, bottom = window
+        results = []
+        for (x0, y0, x1, y1), label, score in detector(image.crop(window)) or []:
+            x0, y0, x1, y1 = x0 + left, y0 + top, x1 + left, y1 + top
+            # 丢弃贴着块内部边缘 (非图片边缘) 的截断框
+            if (
+                (x0 <= left + 1 and left > 0)
+                or (y0 <= top + 1 and top > 0)
+                or (x1 >= right - 1 and right < width)
+                or (y1 >= bottom - 1 and bottom < height)
+            ):
+                continue
+            results.append(((x0, y0, x1, y1), label, score))
+        return results
+
+    results = list(detector(image) or [])
+    for window in tile_windows(image.size, tile_size, overlap):
+        results.extend(run(window))
+    return geometry.suppress(results, contain_threshold=0.8) or None
 
 
 def head(
-    img_path: Path,
+    image: ImageTyping,
 ) -> list[tuple[tuple[int, int, int, int], str, float]] | None:
-    results = detect.detect_heads(img_path)
+    results = detect.detect_heads(image)
     if not results:
         return None
     return results
 
 
 def eyes(
-    img_path: Path,
+    image: ImageTyping,
 ) -> list[tuple[tuple[int, int, int, int], str, float]] | None:
-    results = detect.detect_eyes(img_path)
+    results = detect.detect_eyes(image)
     if not results:
         return None
     return results
 
 
 def faces(
-    img_path: Path,
+    image: ImageTyping,
 ) -> list[tuple[tuple[int, int, int, int], str, float]] | None:
-    results = detect.detect_faces(img_path)
+    results = detect.detect_faces(image)
     if not results:
         return None
     return results
 
 
 def censors(
-    img_path: Path,
+    image: ImageTyping,
 ) -> list[tuple[tuple[int, int, int, int], str, float]] | None:
-    results = detect.detect_censors(img_path)
+    results = detect.detect_censors(image)
     if not results:
         return None
     return results
 
 
 def nudenet(
-    img_path: Path,
+    image: ImageTyping,
 ) -> list[tuple[tuple[int, int, int, int], str, float]] | None:
-    results = detect.detect_with_nudenet(img_path)
+    results = detect.detect_with_nudenet(image)
     if not results:
         return None
     """
@@ -69,37 +147,34 @@ all_labels = [
     return results
 
 
-def nudenet_mongo(
-    img_path: Path,
-) -> list[tuple[tuple[int, int, int, int], str, float]] | None:
-    results = detect.detect_with_nudenet(img_path)
+def filter_labels(
+    results: list[Detection] | None, prefix: str
+) -> list[Detection] | None:
+    """按标签前缀从 NudeNet 结果中筛选对象"""
     if not results:
         return None
-    return [result for result in results if result[1].startswith("FEMALE_GENITALIA")]
+    return [result for result in results if result[1].startswith(prefix)]
+
+
+def nudenet_mongo(
+    image: ImageTyping,
+) -> list[tuple[tuple[int, int, int, int], str, float]] | None:
+    return filter_labels(nudenet(image), "FEMALE_GENITALIA")
 
 
 def nudenet_opai(
-    img_path: Path,
+    image: ImageTyping,
 ) -> list[tuple[tuple[int, int, int, int], str, float]] | None:
-    results = detect.detect_with_nudenet(img_path)
-    if not results:
-        return None
-    return [result for result in results if result[1].startswith("FEMALE_BREAST")]
+    return filter_labels(nudenet(image), "FEMALE_BREAST")
 
 
 def nudenet_armpits(
-    img_path: Path,
+    image: ImageTyping,
 ) -> list[tuple[tuple[int, int, int, int], str, float]] | None:
-    results = detect.detect_with_nudenet(img_path)
-    if not results:
-        return None
-    return [result for result in results if result[1].startswith("ARMPITS")]
+    return filter_labels(nudenet(image), "ARMPITS")
 
 
 def nudenet_feet(
-    img_path: Path,
+    image: ImageTyping,
 ) -> list[tuple[tuple[int, int, int, int], str, float]] | None:
-    results = detect.detect_with_nudenet(img_path)
-    if not results:
-        return None
-    return [result for result in results if result[1].startswith("FEET")]
+    return filter_labels(nudenet(image), "FEET")
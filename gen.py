@@ -1,8 +1,20 @@
+import contextvars
 import enum
-from pathlib import Path
+import io
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from importlib import metadata
+import cache
 import detect
+import geometry
+import metrics
+import numpy as np
 from loguru import logger
-from PIL import Image, ImageDraw, ImageFilter
+from PIL import Image, ImageDraw, ImageFilter, features
 
 
 class GenSquareType(enum.StrEnum):
@@ -29,166 +41,608 @@ detector = {
     GenSquareType.FEET: detect.nudenet_feet,
 }
 
+# NudeNet 派生类型共享同一次 NudeNet 推理，仅按标签前缀筛选
+label_filter = {
+    GenSquareType.MONGO: "FEMALE_GENITALIA",
+    GenSquareType.OPAI: "FEMALE_BREAST",
+    GenSquareType.ARMPITS: "ARMPITS",
+    GenSquareType.FEET: "FEET",
+}
+
+IMGUTILS_VERSION = metadata.version("dghs-imgutils")
+
+# 检测用图的最大边长，超过时在缩小的代理图上检测 (0 表示不启用)
+MAX_DETECT_SIDE = int(os.getenv("MAX_DETECT_SIDE", 0))
+
+# 先检测头部、只在头部区域内运行的类型 (逗号分隔，如 eyes,faces)
+CASCADE_TYPES = {
+    GenSquareType(name.strip())
+    for name in os.getenv("CASCADE_TYPES", "").split(",")
+    if name.strip()
+} & {GenSquareType.EYES, GenSquareType.FACES}
+# 级联检测时头部区域向外扩展的比例
+CASCADE_PADDING = float(os.getenv("CASCADE_PADDING", 0.2))
+# 并发缩放和编码裁剪结果的线程池 (PIL 在缩放和编码时会释放 GIL)
+crop_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("CROP_THREADS", 4)), thread_name_prefix="crop"
+)
+# 运行检测的线程池。imgutils 按线程缓存 ONNX 会话，每个线程各持有一份模型，
+# 因此检测固定在这些线程上运行，启动时逐个线程预热
+DETECT_THREADS = int(os.getenv("DETECT_THREADS", 4))
+detect_pool = ThreadPoolExecutor(
+    max_workers=DETECT_THREADS, thread_name_prefix="detect"
+)
+
+
+def source_type(type: GenSquareType) -> GenSquareType:
+    """返回实际运行模型的检测类型"""
+    return GenSquareType.NUDENET if type in label_filter else type
+
+
+def model_id(type: GenSquareType) -> str:
+    """检测器 (模型) 标识，用于区分缓存结果"""
+    source = source_type(type)
+    mode = ""
+    if source in CASCADE_TYPES:
+        mode += f"+cascade{CASCADE_PADDING:g}"
+    if detect.TILE_SIZE > 0:
+        mode += f"+tile{detect.TILE_SIZE}"
+    return f"{source}{mode}@dghs-imgutils-{IMGUTILS_VERSION}"
+
+
+def _detect_image(source: GenSquareType, image: Image.Image) -> list[detect.Detection]:
+    """在整张图片上运行检测器，超大图片分块检测
+
+    单次推理的结果同样按标签做非极大值抑制，与分块、级联检测的结果一致。
+    """
+    with metrics.stage("detect", source):
+        if detect.needs_tiling(image.size):
+            return detect.tiled(detector[source], image) or []
+        return geometry.suppress(detector[source](image) or [])
+
+
+def _cascade(
+    type: GenSquareType,
+    image: Image.Image,
+    digest: str | None,
+    near_duplicates: bool,
+    use_cache: bool = True,
+) -> list[detect.Detection]:
+    """在扩展后的头部区域内运行检测器，检测框映射回原图后合并重叠结果
+
+    头部检测结果同样经过缓存；未检测到头部时退回整图检测。
+    """
+    heads = _run_model(GenSquareType.HEAD, image, digest, near_duplicates, use_cache)
+    if not heads:
+        return _detect_image(type, image)
+    width, height = image.size
+    results: list[detect.Detection] = []
+    with metrics.stage("detect", type):
+        for (x0, y0, x1, y1), _, _ in heads:
+            pad_x = (x1 - x0) * CASCADE_PADDING
+            pad_y = (y1 - y0) * CASCADE_PADDING
+            left = max(0, int(x0 - pad_x))
+            top = max(0, int(y0 - pad_y))
+            right = min(width, int(math.ceil(x1 + pad_x)))
+            bottom = min(height, int(math.ceil(y1 + pad_y)))
+            if right - left < 2 or bottom - top < 2:
+                continue
+            crop = image.crop((left, top, right, bottom))
+            for (bx0, by0, bx1, by1), label, score in detector[type](crop) or []:
+                results.append(
+                    (
+                        (bx0 + left, by0 + top, bx1 + left, by1 + top),
+                        label,
+                        score,
+                    )
+                )
+    return geometry.suppress(results)
+
+
+def _run_model(
+    type: GenSquareType,
+    image: Image.Image,
+    digest: str | None = None,
+    near_duplicates: bool = True,
+    use_cache: bool = True,
+) -> list[detect.Detection]:
+    """运行检测模型，结果按图片内容哈希和模型标识缓存
+
+    内容哈希未命中时再按感知哈希查找重新压缩或缩放过的同一张图片，
+    找到时把其检测框缩放到当前尺寸，不再运行模型。``use_cache`` 为 False
+    时既不计算哈希也不读写缓存，用于不会重复出现的图片 (如视频帧)。
+    """
+    if not use_cache:
+        if source_type(type) in CASCADE_TYPES:
+            return _cascade(source_type(type), image, None, False, use_cache=False)
+        return _detect_image(source_type(type), image)
+    model = model_id(type)
+    key = cache.make_key(model, digest or cache.image_digest(image))
+    results = cache.detection_cache.get(key)
+    if results is not None:
+        return results
+    signature = None
+    if near_duplicates and cache.near_duplicates.enabled:
+        with metrics.stage("near_duplicate", source_type(type)):
+            signature = cache.Signature(image)
+            found = cache.near_duplicates.lookup(model, signature)
+        if found is not None:
+            results, (width, height) = found
+            results = (
+                scale_results(
+                    results, (image.width / width, image.height / height), image.size
+                )
+                or []
+            )
+            cache.detection_cache.put(key, results)
+            return results
+    if source_type(type) in CASCADE_TYPES:
+        results = _cascade(source_type(type), image, digest, near_duplicates)
+    else:
+        results = _detect_image(source_type(type), image)
+    cache.detection_cache.put(key, results)
+    if signature is not None:
+        cache.near_duplicates.add(model, signature, results)
+    return results
+
+
+def view(
+    type: GenSquareType, results: list[detect.Detection]
+) -> list[detect.Detection] | None:
+    prefix = label_filter.get(type)
+    if prefix is not None:
+        results = detect.filter_labels(results, prefix)
+    metrics.record_detections(type, len(results))
+    return results or None
+
+
+def scale_results(
+    results: list[detect.Detection] | None,
+    scale: tuple[float, float],
+    size: tuple[int, int],
+) -> list[detect.Detection] | None:
+    """把代理图上的检测框映射回原图坐标"""
+    if not results or scale == (1.0, 1.0):
+        return results
+    scale_x, scale_y = scale
+    width, height = size
+    return [
+        (
+            (
+                max(0, min(width, round(x0 * scale_x))),
+                max(0, min(height, round(y0 * scale_y))),
+                max(0, min(width, round(x1 * scale_x))),
+                max(0, min(height, round(y1 * scale_y))),
+            ),
+            label,
+            score,
+        )
+        for (x0, y0, x1, y1), label, score in results
+    ]
+
+
+def detect_objects(
+    type: GenSquareType,
+    image: Image.Image,
+    near_duplicates: bool = True,
+    use_cache: bool = True,
+) -> list[detect.Detection] | None:
+    """运行指定类型的检测器
+
+    ``near_duplicates`` 为 False 时不复用近似图片的结果，``use_cache`` 为
+    False 时完全绕过检测缓存。
+    """
+    return view(
+        type,
+        _run_model(type, image, near_duplicates=near_duplicates, use_cache=use_cache),
+    )
+
+
+def group_types(
+    types: list[GenSquareType],
+) -> dict[GenSquareType, list[GenSquareType]]:
+    """按实际运行的模型对类型分组，不同分组之间相互独立"""
+    groups: dict[GenSquareType, list[GenSquareType]] = {}
+    for type in types:
+        groups.setdefault(source_type(type), []).append(type)
+    return groups
+
+
+def warm_up(types: list[GenSquareType]) -> dict[GenSquareType, float]:
+    """预加载模型并运行一次空白推理，返回每个模型的耗时 (毫秒)
+
+    不经过检测缓存，确保 ONNX 会话创建和首次图优化都在此处完成。
+    """
+    dummy = Image.new("RGB", (640, 640))
+    timings: dict[GenSquareType, float] = {}
+    for source in group_types(types):
+        started = time.perf_counter()
+        detector[source](dummy)
+        timings[source] = (time.perf_counter() - started) * 1000
+        logger.info(f"模型 {source} 预热完成，耗时 {timings[source]:.0f} ms")
+    return timings
+
+
+def warm_up_pool(types: list[GenSquareType]) -> dict[GenSquareType, float]:
+    """在检测线程池的每个线程上预热模型，返回每个模型最慢一次的耗时 (毫秒)"""
+    barrier = threading.Barrier(DETECT_THREADS)
+
+    def warm() -> dict[GenSquareType, float]:
+        # 每个任务占住一个线程直到所有任务都开始运行，保证每个线程各预热一次
+        barrier.wait()
+        return warm_up(types)
+
+    timings: dict[GenSquareType, float] = {}
+    for future in [detect_pool.submit(warm) for _ in range(DETECT_THREADS)]:
+        for source, elapsed in future.result().items():
+            timings[source] = max(timings.get(source, 0.0), elapsed)
+    return timings
+
+
+def detect_batch(
+    type: GenSquareType,
+    images: list[Image.Image],
+    contexts: list[contextvars.Context] | None = None,
+) -> list[list[detect.Detection]]:
+    """对同一模型依次检测多张图片，内容相同的图片只推理一次
+
+    给出 ``contexts`` 时每张图片在对应的上下文中检测，阶段耗时记入提交它的请求。
+    """
+    seen: dict[str, list[detect.Detection]] = {}
+    outputs: list[list[detect.Detection]] = []
+    for index, image in enumerate(images):
+        digest = cache.image_digest(image)
+        if digest not in seen:
+            if contexts is None:
+                seen[digest] = _run_model(type, image, digest)
+            else:
+                seen[digest] = contexts[index].run(_run_model, type, image, digest)
+        outputs.append(seen[digest])
+    return outputs
+
+
+def detect_many(
+    types: list[GenSquareType], image: Image.Image
+) -> dict[GenSquareType, list[detect.Detection] | None]:
+    """一次检测多个类型，共享同一模型的类型只推理一次"""
+    grouped: dict[GenSquareType, list[detect.Detection] | None] = {}
+    for source, members in group_types(types).items():
+        results = _run_model(source, image)
+        for type in members:
+            grouped[type] = view(type, results)
+    return grouped
+
+
+# 输出格式: (PIL 格式名, MIME 类型, 文件后缀)
+output_formats = {
+    "png": ("PNG", "image/png", ".png"),
+    "webp": ("WEBP", "image/webp", ".webp"),
+    "jpeg": ("JPEG", "image/jpeg", ".jpg"),
+    "avif": ("AVIF", "image/avif", ".avif"),
+}
+
+
+def format_supported(format: str) -> bool:
+    """当前 Pillow 是否支持编码该格式"""
+    if format not in output_formats:
+        return False
+    return format in ("png", "jpeg") or features.check(format)
+
+
+@dataclass(frozen=True)
+class Encoding:
+    """输出图片的编码设置"""
+
+    format: str = "png"
+    quality: int | None = None
+    compress_level: int | None = None
+    # WebP 编码速度 (0 最快，6 最慢)
+    method: int | None = None
+
+    @property
+    def media_type(self) -> str:
+        return output_formats[self.format][1]
+
+    @property
+    def suffix(self) -> str:
+        return output_formats[self.format][2]
+
+
+PNG = Encoding()
+
+# 预设，可直接作为 format 使用
+encoding_presets = {
+    "fast": Encoding("webp", quality=80, method=0),
+    "png-fast": Encoding("png", compress_level=1),
+}
+
+
+def encode(image: Image.Image, encoding: Encoding = PNG, **save_options) -> bytes:
+    """按编码设置把图片编码为字节，``save_options`` 直接传给 Image.save (如动画参数)"""
+    pil_format = output_formats[encoding.format][0]
+    options: dict = {}
+    if encoding.format == "png":
+        if encoding.compress_level is not None:
+            options["compress_level"] = encoding.compress_level
+    else:
+        if encoding.quality is not None:
+            options["quality"] = encoding.quality
+        if encoding.format == "webp" and encoding.method is not None:
+            options["method"] = encoding.method
+        if encoding.format == "jpeg" and image.mode not in ("RGB", "L", "CMYK"):
+            image = image.convert("RGB")
+        elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+    buffer = io.BytesIO()
+    with metrics.stage("encode"):
+        image.save(buffer, format=pil_format, **options, **save_options)
+    return buffer.getvalue()
+
 
 def square(
     type: GenSquareType,
-    img_path: Path,
-    output_dir: Path,
+    image: Image.Image,
     target_size: int = 512,
     padding_ratio: float = 0.3,
-) -> list[Path] | None:
+    results: list[detect.Detection] | None = None,
+    encoding: Encoding = PNG,
+    min_score: float = 0.0,
+    max_objects: int = 0,
+) -> list[bytes] | None:
     """
     检测对象区域并生成正方形图片
 
     Args:
-        image_path: 输入图片路径
-        output_dir: 输出目录
+        image: 已解码的输入图片
         target_size: 目标正方形边长 (像素)
         padding_ratio: 对象周围的扩展比例 (0.3表示在对象基础上向外扩展30%)
+        results: 已有的检测结果，为 None 时在此处运行检测
+        encoding: 输出图片的编码设置
+        min_score: 最低置信度
+        max_objects: 最多生成的对象数 (按置信度，0 表示不限)
 
     Returns:
-        list[Path] | None: 返回生成的正方形图片路径列表，如果未检测到对象则返回 None
+        list[bytes] | None: 返回生成的正方形图片列表，如果未检测到对象则返回 None
     """
     if detector.get(type) is None:
         logger.error(f"不支持的类型: {type}")
         return None
-    results = detector[type](img_path)
+    if results is None:
+        results = detect_objects(type, image)
+    results = geometry.select(results, min_score, max_objects)
     if not results:
         logger.error("未检测到任何对象")
         return None
-    if not output_dir.exists():
-        output_dir.mkdir(parents=True, exist_ok=True)
-
-    result_paths: list[Path] = []
-    for i, result in enumerate(results):
-        x0, y0, x1, y1 = result[0]
-        # 打开图片
-        img = Image.open(img_path)
-        img_width, img_height = img.size
-
-        # 计算头部中心点和扩展后的正方形尺寸
-        center_x = (x0 + x1) // 2
-        center_y = (y0 + y1) // 2
-        base_size = max(x1 - x0, y1 - y0)
-        expanded_size = int(base_size * (1 + padding_ratio * 2))
-
-        # 计算正方形裁剪区域的初始坐标
-        half_size = expanded_size // 2
-        crop_x0 = max(0, center_x - half_size)
-        crop_y0 = max(0, center_y - half_size)
-        crop_x1 = min(img_width, center_x + half_size)
-        crop_y1 = min(img_height, center_y + half_size)
-
-        # 调整为正方形并确保不超出边界
-        square_size = min(crop_x1 - crop_x0, crop_y1 - crop_y0)
-
-        new_crop_x0 = max(0, min(center_x - square_size // 2, img_width - square_size))
-        new_crop_y0 = max(0, min(center_y - square_size // 2, img_height - square_size))
-        new_crop_x1 = new_crop_x0 + square_size
-        new_crop_y1 = new_crop_y0 + square_size
-
-        # 裁剪、调整尺寸并保存
-        square_img = img.crop((new_crop_x0, new_crop_y0, new_crop_x1, new_crop_y1))
+    crops = crop_squares(image, results, target_size, padding_ratio, encoding)
+    if not crops:
+        logger.error("未生成任何头像图片")
+        return None
+    return crops
+
+
+def _render_square(
+    image: Image.Image,
+    window: tuple[int, int, int, int],
+    target_size: int,
+    encoding: Encoding,
+) -> bytes:
+    with metrics.stage("crop"):
+        square_img = image.crop(window)
         final_img = square_img.resize(
             (target_size, target_size), Image.Resampling.LANCZOS
         )
-        output_path = output_dir / f"{img_path.stem}_{type}_{i}.png"
-        final_img.save(output_path, format="PNG")
-        logger.info(f"头像已保存到: {output_path}")
-        result_paths.append(output_path)
-    if not result_paths:
-        logger.error("未生成任何头像图片")
-        return None
-    return result_paths
+    return encode(final_img, encoding)
+
+
+def crop_squares(
+    image: Image.Image,
+    results: list[detect.Detection],
+    target_size: int = 512,
+    padding_ratio: float = 0.3,
+    encoding: Encoding = PNG,
+) -> list[bytes]:
+    """按检测结果裁剪正方形图片并编码
+
+    图片只解码一次，所有裁剪区域一次算出，缩放和编码并发进行。
+    """
+    if not results:
+        return []
+    windows = [
+        tuple(window)
+        for window in geometry.square_windows(
+            geometry.boxes_of(results), image.size, padding_ratio
+        ).tolist()
+    ]
+    with metrics.stage("decode"):
+        image.load()
+    if len(windows) == 1:
+        crops = [_render_square(image, windows[0], target_size, encoding)]
+    else:
+        # 每个任务复制一份上下文，阶段耗时计入发起请求的 Server-Timing
+        contexts = [contextvars.copy_context() for _ in windows]
+        crops = list(
+            crop_pool.map(
+                lambda context, window: context.run(
+                    _render_square, image, window, target_size, encoding
+                ),
+                contexts,
+                windows,
+            )
+        )
+    logger.info(f"已生成 {len(crops)} 个正方形图片")
+    return crops
 
 
 def mask(
     type: GenSquareType,
-    img_path: Path,
-    output_dir: Path,
+    image: Image.Image,
     padding_ratio: float = 0.2,
     color: str = "red",
     width: int = 8,
-) -> Path:
-    """Mark an area in the image based on the detected object."""
+    results: list[detect.Detection] | None = None,
+    encoding: Encoding = PNG,
+    min_score: float = 0.0,
+    max_objects: int = 0,
+) -> bytes:
+    """Mark an area in the image based on the detected object.
+
+    The boxes are drawn onto ``image`` in place; if nothing is detected the
+    image is returned unchanged.
+    """
     if detector.get(type) is None:
         logger.error(f"不支持的类型: {type}")
-        return img_path
-    results = detector[type](img_path)
+        return encode(image, encoding)
+    if results is None:
+        results = detect_objects(type, image)
+    results = geometry.select(results, min_score, max_objects)
     if not results:
         logger.error("未检测到任何对象")
-        return img_path
-    image = Image.open(img_path)
+        return encode(image, encoding)
     draw = ImageDraw.Draw(image)
-    img_width, img_height = image.size
+    boxes = geometry.clamp(
+        geometry.pad(geometry.boxes_of(results), padding_ratio), image.size
+    )
+    for nx0, ny0, nx1, ny1 in boxes.tolist():
+        draw.rectangle([(nx0, ny0), (nx1, ny1)], outline=color, width=width)
+    logger.info(f"已标记 {len(results)} 个 {type} 对象")
+    return encode(image, encoding)
 
-    for (x0, y0, x1, y1), _, _ in results:
-        box_width = x1 - x0
-        box_height = y1 - y0
-        pad_w = box_width * padding_ratio
-        pad_h = box_height * padding_ratio
 
-        nx0 = max(0, x0 - pad_w)
-        ny0 = max(0, y0 - pad_h)
-        nx1 = min(img_width, x1 + pad_w)
-        ny1 = min(img_height, y1 + pad_h)
+# 模糊半径不小于该值的两倍时，先在缩小的图上模糊再放大 (缩小倍数为 半径 // 该值)
+BLUR_DOWNSCALE_RADIUS = 8
+# 判断区域是否被高亮框完全覆盖时使用的分块大小
+BLUR_TILE_SIZE = 256
+
+
+def _blur(image: Image.Image, radius: float) -> Image.Image:
+    """高斯模糊，半径较大时在缩小后的图上模糊再放大"""
+    factor = int(radius // BLUR_DOWNSCALE_RADIUS)
+    if factor < 2 or min(image.size) < factor * 4:
+        return image.filter(ImageFilter.GaussianBlur(radius=radius))
+    small = image.reduce(factor)
+    # 扣除缩小 (区域平均) 本身带来的模糊量
+    sigma = math.sqrt(radius**2 - factor**2 / 4) / factor
+    small = small.filter(ImageFilter.GaussianBlur(radius=sigma))
+    return small.resize(image.size, Image.Resampling.BILINEAR)
 
-        draw.rectangle([(nx0, ny0), (nx1, ny1)], outline=color, width=width)
-    output_path = output_dir / f"{img_path.stem}_{type}_marked.png"
-    image.save(output_path, format="PNG")
-    logger.info(f"标记后的图片已保存到: {output_path}")
-    return output_path
+
+def _uncovered_regions(
+    size: tuple[int, int], regions: np.ndarray, tile: int = BLUR_TILE_SIZE
+) -> list[tuple[int, int, int, int]]:
+    """返回未被高亮区域完全覆盖的矩形区域 (按分块合并)"""
+    width, height = size
+    cols = -(-width // tile)
+    rows = -(-height // tile)
+    covered = np.zeros((rows, cols), dtype=bool)
+    # 完全落在某个高亮区域内的分块不需要模糊
+    first_col = -(-regions[:, 0] // tile)
+    first_row = -(-regions[:, 1] // tile)
+    last_col = np.where(regions[:, 2] >= width, cols, regions[:, 2] // tile)
+    last_row = np.where(regions[:, 3] >= height, rows, regions[:, 3] // tile)
+    for c0, r0, c1, r1 in zip(first_col, first_row, last_col, last_row):
+        covered[r0:r1, c0:c1] = True
+
+    # 每行取出连续的未覆盖分块，再把跨度相同的相邻行合并为一个矩形
+    spans: list[tuple[int, int, int, int]] = []
+    open_spans: dict[tuple[int, int], int] = {}
+    for row in range(rows + 1):
+        row_spans: set[tuple[int, int]] = set()
+        if row < rows:
+            col = 0
+            while col < cols:
+                if covered[row, col]:
+                    col += 1
+                    continue
+                start = col
+                while col < cols and not covered[row, col]:
+                    col += 1
+                row_spans.add((start, col))
+        for span in list(open_spans):
+            if span not in row_spans:
+                spans.append((span[0], open_spans.pop(span), span[1], row))
+        for span in row_spans:
+            open_spans.setdefault(span, row)
+    return [
+        (c0 * tile, r0 * tile, min(width, c1 * tile), min(height, r1 * tile))
+        for c0, r0, c1, r1 in spans
+    ]
 
 
 def highlight(
     type: GenSquareType,
-    img_path: Path,
-    output_dir: Path,
+    image: Image.Image,
     padding_ratio: float = 0.3,
     blur_radius: float = 15,
     with_mask: bool = False,
     mask_color: str = "red",
     mask_width: int = 8,
-) -> Path:
+    results: list[detect.Detection] | None = None,
+    encoding: Encoding = PNG,
+    min_score: float = 0.0,
+    max_objects: int = 0,
+) -> bytes:
+    """Blur everything except the detected objects.
+
+    Only tiles not fully covered by a highlight box are blurred, and the boxes
+    are pasted back from the original. Radii of 16 and above are blurred on a
+    reduced copy: the result differs from a full-resolution blur by under
+    1/255 on average, with larger deviations only near the image border.
+    """
     if detector.get(type) is None:
         logger.error(f"Unsupported type: {type}")
-        return img_path
+        return encode(image, encoding)
 
-    results = detector[type](img_path)
+    if results is None:
+        results = detect_objects(type, image)
+    results = geometry.select(results, min_score, max_objects)
     if not results:
         logger.error("No objects detected")
-        return img_path
-    image = Image.open(img_path).convert("RGB")
-    blurred = image.filter(ImageFilter.GaussianBlur(radius=blur_radius))
+        return encode(image, encoding)
+    image = image.convert("RGB")
     img_width, img_height = image.size
-    mask = Image.new("L", (img_width, img_height), 0)
-    mask_draw = ImageDraw.Draw(mask)
-    boxes = []
-    for (x0, y0, x1, y1), label, score in results:
-        box_w = x1 - x0
-        box_h = y1 - y0
-        pad_w = box_w * padding_ratio
-        pad_h = box_h * padding_ratio
-
-        nx0 = max(0, x0 - pad_w)
-        ny0 = max(0, y0 - pad_h)
-        nx1 = min(img_width, x1 + pad_w)
-        ny1 = min(img_height, y1 + pad_h)
-
-        mask_draw.rectangle([(nx0, ny0), (nx1, ny1)], fill=255)
-        boxes.append((nx0, ny0, nx1, ny1))
-
-    highlighted = Image.composite(image, blurred, mask)
-
-    if with_mask and boxes:
+    boxes = geometry.clamp(
+        geometry.pad(geometry.boxes_of(results), padding_ratio), image.size
+    )
+
+    # 与 ImageDraw.rectangle 填充的像素范围一致 (截断取整，包含右下边界)
+    regions = boxes.astype(np.int64)
+    regions[:, 2:] += 1
+    regions = geometry.clamp(regions, image.size)
+
+    highlighted = image.copy()
+    if blur_radius > 0:
+        margin = int(blur_radius * 3) + 1
+        for x0, y0, x1, y1 in _uncovered_regions(image.size, regions):
+            context = (
+                max(0, x0 - margin),
+                max(0, y0 - margin),
+                min(img_width, x1 + margin),
+                min(img_height, y1 + margin),
+            )
+            blurred = _blur(image.crop(context), blur_radius)
+            inner = (
+                x0 - context[0],
+                y0 - context[1],
+                x1 - context[0],
+                y1 - context[1],
+            )
+            highlighted.paste(blurred.crop(inner), (x0, y0))
+        for x0, y0, x1, y1 in regions.tolist():
+            if x1 > x0 and y1 > y0:
+                highlighted.paste(image.crop((x0, y0, x1, y1)), (x0, y0))
+
+    if with_mask:
         draw = ImageDraw.Draw(highlighted)
-        for nx0, ny0, nx1, ny1 in boxes:
+        for nx0, ny0, nx1, ny1 in boxes.tolist():
             draw.rectangle(
                 [(nx0, ny0), (nx1, ny1)], outline=mask_color, width=mask_width
             )
 
-    output_path = output_dir / f"{img_path.stem}_{type}_highlighted.png"
-    if not output_dir.exists():
-        output_dir.mkdir(parents=True, exist_ok=True)
-    highlighted.save(output_path)
-    return output_path
+    return encode(highlighted, encoding)
+
+
+generators = {
+    "square": square,
+    "mask": mask,
+    "highlight": highlight,
+}
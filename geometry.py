@@ -0,0 +1,159 @@
+import numpy as np
+
+Detection = tuple[tuple[int, int, int, int], str, float]
+
+# 合并重叠检测框的 IoU 阈值
+NMS_IOU = 0.5
+
+
+def boxes_of(results: list[Detection]) -> np.ndarray:
+    """检测结果中的检测框，形状为 (N, 4)"""
+    return np.array([box for box, _, _ in results], dtype=np.float64).reshape(-1, 4)
+
+
+def scores_of(results: list[Detection]) -> np.ndarray:
+    return np.array([score for _, _, score in results], dtype=np.float64)
+
+
+def pad(boxes: np.ndarray, ratio: float) -> np.ndarray:
+    """按检测框宽高的 ``ratio`` 倍向四周扩展"""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    pad_w = (boxes[:, 2] - boxes[:, 0]) * ratio
+    pad_h = (boxes[:, 3] - boxes[:, 1]) * ratio
+    return boxes + np.stack([-pad_w, -pad_h, pad_w, pad_h], axis=1)
+
+
+def clamp(boxes: np.ndarray, size: tuple[int, int]) -> np.ndarray:
+    """把检测框限制在图片范围内"""
+    width, height = size
+    boxes = np.array(boxes, copy=True).reshape(-1, 4)
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, width)
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, height)
+    return boxes
+
+
+def square_windows(
+    boxes: np.ndarray, size: tuple[int, int], padding_ratio: float = 0.3
+) -> np.ndarray:
+    """批量计算以对象为中心的正方形裁剪区域
+
+    Args:
+        boxes: 形状为 (N, 4) 的检测框 (x0, y0, x1, y1)
+        size: 图片尺寸 (宽, 高)
+        padding_ratio: 对象周围的扩展比例
+
+    Returns:
+        np.ndarray: 形状为 (N, 4) 的正方形裁剪区域，不超出图片边界
+    """
+    img_width, img_height = size
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    x0, y0, x1, y1 = boxes.T
+
+    # 计算对象中心点和扩展后的正方形尺寸
+    center_x = (x0 + x1) // 2
+    center_y = (y0 + y1) // 2
+    base_size = np.maximum(x1 - x0, y1 - y0)
+    expanded_size = (base_size * (1 + padding_ratio * 2)).astype(np.int64)
+
+    # 计算正方形裁剪区域的初始坐标
+    half_size = expanded_size // 2
+    crop_x0 = np.maximum(0, center_x - half_size)
+    crop_y0 = np.maximum(0, center_y - half_size)
+    crop_x1 = np.minimum(img_width, center_x + half_size)
+    crop_y1 = np.minimum(img_height, center_y + half_size)
+
+    # 调整为正方形并确保不超出边界
+    square_size = np.minimum(crop_x1 - crop_x0, crop_y1 - crop_y0)
+    new_x0 = np.maximum(
+        0, np.minimum(center_x - square_size // 2, img_width - square_size)
+    )
+    new_y0 = np.maximum(
+        0, np.minimum(center_y - square_size // 2, img_height - square_size)
+    )
+    return np.stack(
+        [new_x0, new_y0, new_x0 + square_size, new_y0 + square_size], axis=1
+    )
+
+
+def _intersections(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    x0 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y0 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x1 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y1 = np.minimum(a[:, None, 3], b[None, :, 3])
+    return np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+
+
+def _areas(boxes: np.ndarray) -> np.ndarray:
+    return (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+
+def iou(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """两组检测框两两之间的 IoU，形状为 (len(a), len(b))"""
+    inter = _intersections(a, b)
+    union = _areas(a)[:, None] + _areas(b)[None, :] - inter
+    return inter / np.maximum(union, 1e-9)
+
+
+def nms(
+    boxes: np.ndarray,
+    scores: np.ndarray,
+    iou_threshold: float = NMS_IOU,
+    labels: list[str] | None = None,
+    contain_threshold: float | None = None,
+) -> np.ndarray:
+    """非极大值抑制，返回保留的检测框下标 (升序)
+
+    与更高置信度的框 IoU 超过阈值的框被移除；设置 ``contain_threshold`` 时，
+    大部分面积落在更高置信度框内的框也被移除。给出 ``labels`` 时只在同一
+    标签内比较。
+    """
+    count = len(scores)
+    if count < 2:
+        return np.arange(count)
+    order = np.argsort(-np.asarray(scores), kind="stable")
+    boxes = np.asarray(boxes, dtype=np.float64)[order]
+    inter = _intersections(boxes, boxes)
+    areas = _areas(boxes)
+    suppress = inter / np.maximum(areas[:, None] + areas[None, :] - inter, 1e-9) > (
+        iou_threshold
+    )
+    if contain_threshold is not None:
+        suppress |= inter / np.maximum(areas[None, :], 1e-9) > contain_threshold
+    if labels is not None:
+        ordered = np.asarray(labels, dtype=object)[order]
+        suppress &= ordered[:, None] == ordered[None, :]
+    keep = np.ones(count, dtype=bool)
+    for i in range(count):
+        if keep[i]:
+            keep[i + 1 :] &= ~suppress[i, i + 1 :]
+    return np.sort(order[keep])
+
+
+def suppress(
+    results: list[Detection],
+    iou_threshold: float = NMS_IOU,
+    contain_threshold: float | None = None,
+) -> list[Detection]:
+    """按标签对检测结果做非极大值抑制，保持原有顺序"""
+    keep = nms(
+        boxes_of(results),
+        scores_of(results),
+        iou_threshold,
+        labels=[label for _, label, _ in results],
+        contain_threshold=contain_threshold,
+    )
+    return [results[i] for i in keep]
+
+
+def select(
+    results: list[Detection] | None, min_score: float = 0.0, max_objects: int = 0
+) -> list[Detection] | None:
+    """按置信度筛选并只保留置信度最高的 ``max_objects`` 个对象 (0 表示不限)，保持原有顺序"""
+    if not results or (min_score <= 0 and max_objects <= 0):
+        return results
+    scores = scores_of(results)
+    indices = np.flatnonzero(scores >= min_score)
+    if 0 < max_objects < len(indices):
+        top = np.argsort(-scores[indices], kind="stable")[:max_objects]
+        indices = np.sort(indices[top])
+    return [results[i] for i in indices] or None
@@ -0,0 +1,285 @@
+import asyncio
+import contextvars
+import enum
+import ipaddress
+import itertools
+import os
+import socket
+import time
+import uuid
+from collections import deque
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+
+import httpx
+from loguru import logger
+
+
+# 允许接收回调的主机名，逗号分隔；为空时允许任意只解析到公网地址的主机
+CALLBACK_HOSTS = {
+    host.strip().lower()
+    for host in os.getenv("JOB_CALLBACK_HOSTS", "").split(",")
+    if host.strip()
+}
+
+
+class QueueFullError(Exception):
+    """任务队列已满"""
+
+
+class CallbackError(ValueError):
+    """回调地址不允许使用"""
+
+
+async def check_callback_url(
+    url: str, allowed_hosts: set[str] = CALLBACK_HOSTS
+) -> None:
+    """校验回调地址，防止借回调访问内网服务 (SSRF)
+
+    配置了 ``allowed_hosts`` 时只允许其中的主机；否则主机解析出的所有地址
+    都必须是公网地址，回环、内网、链路本地 (含云元数据服务) 和保留地址
+    均被拒绝。回调发送前会再次校验，防止 DNS 记录在提交后被改为内网地址。
+    """
+    try:
+        parsed = httpx.URL(url)
+    except httpx.InvalidURL:
+        raise CallbackError("回调地址格式错误")
+    if parsed.scheme not in ("http", "https") or not parsed.host:
+        raise CallbackError("回调地址必须是 http(s) URL")
+    host = parsed.host.lower()
+    if allowed_hosts:
+        if host not in allowed_hosts:
+            raise CallbackError(f"回调地址的主机 {host} 不在允许列表中")
+        return
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            host, port, type=socket.SOCK_STREAM
+        )
+    except socket.gaierror:
+        raise CallbackError(f"无法解析回调地址的主机 {host}")
+    for *_, sockaddr in infos:
+        address = ipaddress.ip_address(sockaddr[0].split("%", 1)[0])
+        if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global:
+            raise CallbackError("回调地址不能指向内网、回环或保留地址")
+
+
+class JobStatus(enum.StrEnum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+
+@dataclass
+class Job:
+    """异步任务，``run`` 返回生成结果在结果存储中的 id 列表"""
+
+    id: str
+    kind: str
+    priority: int
+    run: Callable[[], Awaitable[list[str]]] | None = field(repr=False)
+    base_url: str = ""
+    callback_url: str | None = None
+    status: JobStatus = JobStatus.QUEUED
+    created: float = field(default_factory=time.time)
+    started: float | None = None
+    finished: float | None = None
+    result_ids: list[str] = field(default_factory=list)
+    error: str | None = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in (JobStatus.SUCCEEDED, JobStatus.FAILED)
+
+    def to_dict(self) -> dict:
+        data = {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "priority": self.priority,
+            "created": self.created,
+            "wait_ms": None,
+            "run_ms": None,
+        }
+        if self.started is not None:
+            data["wait_ms"] = round((self.started - self.created) * 1000, 2)
+        if self.started is not None and self.finished is not None:
+            data["run_ms"] = round((self.finished - self.started) * 1000, 2)
+        if self.status == JobStatus.SUCCEEDED:
+            data["count"] = len(self.result_ids)
+            data["urls"] = [
+                f"{self.base_url}/result/{result_id}" for result_id in self.result_ids
+            ]
+            data["result"] = f"{self.base_url}/jobs/{self.id}/result"
+        if self.error is not None:
+            data["error"] = self.error
+        return data
+
+
+class JobQueue:
+    """有界优先级任务队列
+
+    任务按优先级 (数值大的先执行)、再按提交顺序由 ``workers`` 个协程执行；
+    排队任务超过 ``max_queue`` 时拒绝提交。完成的任务保留 ``retention`` 秒
+    供查询，设置了回调地址时在完成后以 POST 推送任务状态。
+    """
+
+    def __init__(self, workers: int = 2, max_queue: int = 100, retention: float = 3600):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.retention = retention
+        self.submitted = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.rejected = 0
+        self.running = 0
+        self._jobs: dict[str, Job] = {}
+        self._waits: deque[float] = deque(maxlen=1000)
+        self._order = itertools.count()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._queue: asyncio.PriorityQueue | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def _start(self) -> asyncio.PriorityQueue:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop or self._queue is None:
+            # 事件循环变化 (如重启服务) 时丢弃旧的队列
+            self.close()
+            self._loop = loop
+            self._queue = asyncio.PriorityQueue()
+            for _ in range(self.workers):
+                self._spawn(self._work(self._queue))
+        return self._queue
+
+    def _spawn(self, coro) -> None:
+        # 使用空白上下文，任务的阶段耗时不计入提交它的请求
+        task = asyncio.get_running_loop().create_task(
+            coro, context=contextvars.Context()
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _prune(self) -> None:
+        now = time.time()
+        for id in [
+            id
+            for id, job in self._jobs.items()
+            if job.done and now - (job.finished or now) > self.retention
+        ]:
+            del self._jobs[id]
+
+    def submit(
+        self,
+        kind: str,
+        run: Callable[[], Awaitable[list[str]]],
+        priority: int = 0,
+        base_url: str = "",
+        callback_url: str | None = None,
+    ) -> Job:
+        """提交任务，队列已满时抛出 QueueFullError"""
+        queue = self._start()
+        self._prune()
+        if queue.qsize() >= self.max_queue:
+            self.rejected += 1
+            raise QueueFullError("任务队列已满")
+        job = Job(
+            id=uuid.uuid4().hex,
+            kind=kind,
+            priority=priority,
+            run=run,
+            base_url=base_url,
+            callback_url=callback_url,
+        )
+        self._jobs[job.id] = job
+        queue.put_nowait((-priority, next(self._order), job))
+        self.submitted += 1
+        return job
+
+    def get(self, id: str) -> Job | None:
+        return self._jobs.get(id)
+
+    async def _work(self, queue: asyncio.PriorityQueue) -> None:
+        while True:
+            _, _, job = await queue.get()
+            job.status = JobStatus.RUNNING
+            job.started = time.time()
+            self._waits.append(job.started - job.created)
+            self.running += 1
+            try:
+                assert job.run is not None
+                job.result_ids = await job.run()
+                job.status = JobStatus.SUCCEEDED
+                self.succeeded += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"任务 {job.id} 执行失败: {str(e)}")
+                job.error = getattr(e, "detail", None) or str(e)
+                job.status = JobStatus.FAILED
+                self.failed += 1
+            finally:
+                self.running -= 1
+                job.finished = time.time()
+                # 释放上传内容
+                job.run = None
+            if job.callback_url:
+                self._spawn(self._notify(job))
+
+    async def _notify(self, job: Job, attempts: int = 3) -> None:
+        """把任务状态推送到回调地址，失败时重试"""
+        async with httpx.AsyncClient(timeout=10) as client:
+            for attempt in range(attempts):
+                try:
+                    await check_callback_url(job.callback_url)
+                except CallbackError as e:
+                    logger.error(f"任务 {job.id} 回调地址不允许: {str(e)}")
+                    return
+                try:
+                    response = await client.post(job.callback_url, json=job.to_dict())
+                    response.raise_for_status()
+                    return
+                except Exception as e:
+                    logger.error(
+                        f"任务 {job.id} 回调失败 ({attempt + 1}/{attempts}): {str(e)}"
+                    )
+                if attempt + 1 < attempts:
+                    await asyncio.sleep(2**attempt)
+
+    def stats(self) -> dict:
+        waits = list(self._waits)
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "running": self.running,
+            "submitted": self.submitted,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "wait_ms": {
+                "avg": round(sum(waits) / len(waits) * 1000, 2) if waits else None,
+                "max": round(max(waits) * 1000, 2) if waits else None,
+            },
+        }
+
+    def close(self) -> None:
+        for task in list(self._tasks):
+            if not task.get_loop().is_closed():
+                task.cancel()
+        self._tasks.clear()
+        self._queue = None
+
+
+def from_env() -> JobQueue:
+    """由环境变量创建任务队列"""
+    return JobQueue(
+        workers=int(os.getenv("JOB_WORKERS", 2)),
+        max_queue=int(os.getenv("JOB_MAX_QUEUE", 100)),
+        retention=float(os.getenv("JOB_RETENTION", 3600)),
+    )
+
+
+job_queue = from_env()
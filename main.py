@@ -1,7 +1,7 @@
 import os
-from pathlib import Path
 from fastapi import (
     BackgroundTasks,
+    Depends,
     FastAPI,
     File,
     Form,
@@ -11,24 +11,101 @@ from fastapi import (
     Request,
 )
 from starlette.background import BackgroundTask
-from fastapi.responses import FileResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from loguru import logger
+from PIL import Image
 import asyncio
-import tempfile
+import contextvars
+import dataclasses
+import functools
+import json
+import re
+import time
+import uuid
+import zipfile
+from contextlib import asynccontextmanager
 
+import admission
+import cache
 import gen
+import geometry
+from detect import Detection
+import jobs
+import metrics
+import scheduler
+import store
+import uploads
 import utils
+import video
+import workers
 
-OUTPUT_DIR = Path(__file__).parent / "output"
-INPUT_DIR = Path(__file__).parent / "input"
-if not OUTPUT_DIR.exists():
-    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
-if not INPUT_DIR.exists():
-    INPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+WARMUP_TYPES = [
+    name.strip()
+    for name in os.getenv("WARMUP_TYPES", "head").split(",")
+    if name.strip()
+]
+# /cutbatch 同时处理的图片数量
+CUTBATCH_IN_FLIGHT = int(os.getenv("CUTBATCH_IN_FLIGHT", 4))
+# 未指定输出格式且无法从 Accept 头协商时使用的格式 (可为预设名)
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "png")
+# 不需要鉴权的探针接口
+PUBLIC_PATHS = {"/health", "/ready"}
 
-app = FastAPI(title="Cut Avatar API")
+readiness: dict = {"ready": False, "models": {}, "error": None}
+
+
+async def warm_up() -> None:
+    """预加载并预热模型，完成后将实例标记为就绪"""
+    try:
+        if workers.process_pool is not None:
+            await workers.process_pool.start()
+        else:
+            types = [gen.GenSquareType(name) for name in WARMUP_TYPES]
+            # 检测线程池和调度器的推理线程各自持有 ONNX 会话，分别在这些线程上预热
+            timings = await asyncio.to_thread(gen.warm_up_pool, types)
+            if scheduler.inference_scheduler is not None:
+                timings |= await scheduler.inference_scheduler.warm_up(types)
+            readiness["models"] = {
+                type: round(elapsed, 2) for type, elapsed in timings.items()
+            }
+        readiness["ready"] = True
+        logger.info("模型预热完成，服务已就绪")
+    except Exception as e:
+        readiness["error"] = str(e)
+        logger.error(f"模型预热失败: {str(e)}")
+
+
+async def sweep_results() -> None:
+    """定期清理过期的生成结果和遗留文件"""
+    while True:
+        await asyncio.sleep(store.result_store.sweep_interval)
+        try:
+            await asyncio.to_thread(store.result_store.sweep)
+        except Exception as e:
+            logger.error(f"清理生成结果失败: {str(e)}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warm_up_task = asyncio.create_task(warm_up())
+    sweep_task = asyncio.create_task(sweep_results())
+    yield
+    warm_up_task.cancel()
+    sweep_task.cancel()
+    if workers.process_pool is not None:
+        workers.process_pool.shutdown()
+    if scheduler.inference_scheduler is not None:
+        scheduler.inference_scheduler.close()
+    jobs.job_queue.close()
+
+
+app = FastAPI(title="Cut Avatar API", lifespan=lifespan)
+app.add_middleware(
+    uploads.UploadGuardMiddleware, batch_paths={"/cutbatch"}, video_paths={"/cutclip"}
+)
+app.add_middleware(metrics.MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -40,6 +117,8 @@ app.add_middleware(
 
 @app.middleware("http")
 async def auth_middleware(request: Request, call_next):
+    if request.url.path in PUBLIC_PATHS:
+        return await call_next(request)
     auth_header = request.headers.get("Authorization")
     api_key = os.getenv("API_KEY", "")
     if api_key:
@@ -53,21 +132,408 @@ async def auth_middleware(request: Request, call_next):
     return response
 
 
-@app.get("/result/{id}")
-async def download_result(id: str):
-    result_file = OUTPUT_DIR / f"{id}.png"
-    if not result_file.exists():
+async def read_image(file: UploadFile, allow_video: bool = False) -> bytes:
+    """读取上传的图片内容，按文件头而非客户端声明的类型校验格式和尺寸
+
+    上传内容已由表单解析器缓存在临时文件中，校验通过后才读入内存。
+    """
+    with metrics.stage("read"):
+        head = await file.read(uploads.MAX_HEADER_BYTES)
+        if not head:
+            raise HTTPException(status_code=400, detail="文件内容为空")
+        uploads.check_image_header(head, complete=True, allow_video=allow_video)
+        await file.seek(0)
+        content = await file.read()
+    return content
+
+
+def parse_types(types: str) -> list[gen.GenSquareType]:
+    """解析逗号分隔的对象类型列表"""
+    parsed: list[gen.GenSquareType] = []
+    for name in types.split(","):
+        name = name.strip()
+        if not name:
+            continue
+        try:
+            type = gen.GenSquareType(name)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"不支持的类型: {name}")
+        if type not in parsed:
+            parsed.append(type)
+    if not parsed:
+        raise HTTPException(status_code=400, detail="未指定对象类型")
+    return parsed
+
+
+def image_pixels(content: bytes) -> int:
+    """只解析文件头计算图片像素数，超过单张上限时返回 413"""
+    try:
+        width, height = utils.image_size(content)
+    except Image.DecompressionBombError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception:
+        raise HTTPException(status_code=400, detail="无法识别的图片格式")
+    try:
+        admission.pixel_budget.check(width * height)
+    except admission.AdmissionError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    return width * height
+
+
+@asynccontextmanager
+async def admitted(content: bytes, timeout: float | None = -1):
+    """按图片像素数申请处理预算，未被接纳时返回 413/429/503"""
+    async with admit_pixels(image_pixels(content), timeout):
+        yield
+
+
+@asynccontextmanager
+async def admit_pixels(
+    pixels: int, timeout: float | None = -1, count: int = 1, extra: int = 0
+):
+    try:
+        with metrics.stage("admission"):
+            cost = await admission.pixel_budget.acquire(pixels, timeout, count, extra)
+    except admission.AdmissionError as e:
+        headers = {"Retry-After": str(e.retry_after)} if e.retry_after else None
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers=headers)
+    try:
+        yield
+    finally:
+        admission.pixel_budget.release(cost)
+
+
+async def in_detect_pool(func, /, *args, **kwargs):
+    """在已预热的检测线程池中运行，保留当前上下文以便阶段耗时记入该请求"""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        gen.detect_pool, functools.partial(context.run, func, *args, **kwargs)
+    )
+
+
+async def run_detection(
+    types: list[gen.GenSquareType], image: Image.Image
+) -> dict[gen.GenSquareType, list[Detection] | None]:
+    """运行检测，启用调度器时由调度器合并并发请求"""
+    if scheduler.inference_scheduler is None:
+        return await in_detect_pool(gen.detect_many, types, image)
+    try:
+        return await scheduler.inference_scheduler.detect_many(types, image)
+    except scheduler.QueueFullError as e:
+        raise HTTPException(
+            status_code=503, detail=str(e), headers={"Retry-After": "1"}
+        )
+
+
+async def load_and_detect(
+    types: list[gen.GenSquareType], content: bytes
+) -> tuple[Image.Image, dict[gen.GenSquareType, list[Detection] | None]]:
+    """打开图片并检测，超大图片在缩小的代理图上检测后映射回原图坐标"""
+    image, detect_image, scale = await asyncio.to_thread(
+        utils.load_image, content, gen.MAX_DETECT_SIDE
+    )
+    grouped = await run_detection(types, detect_image)
+    return image, {
+        type: gen.scale_results(results, scale, image.size)
+        for type, results in grouped.items()
+    }
+
+
+async def generate(
+    kind: str,
+    type: gen.GenSquareType,
+    content: bytes,
+    admission_timeout: float | None = -1,
+    **kwargs,
+):
+    """解码、检测并调用 gen 中的生成函数
+
+    启用进程池时整个流程在工作进程中完成，否则在线程池中执行。处理前按
+    图片像素数申请预算，``admission_timeout`` 含义同 PixelBudget.acquire。
+    """
+    async with admitted(content, admission_timeout):
+        if workers.process_pool is not None:
+            return await workers.process_pool.run(kind, content, type=type, **kwargs)
+        image, grouped = await load_and_detect([type], content)
+        return await asyncio.to_thread(
+            gen.generators[kind],
+            type=type,
+            image=image,
+            results=grouped[type] or [],
+            **kwargs,
+        )
+
+
+def negotiate_format(accept: str) -> str | None:
+    """根据 Accept 头选择输出格式，未明确声明支持的图片格式时返回 None
+
+    q 值相同时优先选择编码较快的格式。
+    """
+    preference = ["webp", "jpeg", "png", "avif"]
+    best: tuple[float, int] | None = None
+    chosen = None
+    for part in accept.split(","):
+        media_type, *params = [item.strip() for item in part.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        for rank, format in enumerate(preference):
+            if (
+                quality > 0
+                and gen.output_formats[format][1] == media_type.lower()
+                and gen.format_supported(format)
+                and (best is None or (quality, -rank) > best)
+            ):
+                best = (quality, -rank)
+                chosen = format
+    return chosen
+
+
+async def output_encoding(
+    request: Request,
+    format: str | None = Form(
+        None,
+        description="输出格式 (png/webp/jpeg/avif，或预设 fast/png-fast)，未指定时根据 Accept 头协商",
+    ),
+    quality: int | None = Form(
+        None, description="WebP/JPEG/AVIF 编码质量", ge=1, le=100
+    ),
+    compress_level: int | None = Form(
+        None, description="PNG 压缩级别 (0-9，越小越快)", ge=0, le=9
+    ),
+) -> gen.Encoding:
+    name = (
+        (format or "").strip().lower()
+        or negotiate_format(request.headers.get("accept", ""))
+        or OUTPUT_FORMAT
+    )
+    encoding = gen.encoding_presets.get(name)
+    if encoding is None:
+        if not gen.format_supported(name):
+            raise HTTPException(status_code=400, detail=f"不支持的输出格式: {name}")
+        encoding = gen.Encoding(name)
+    if quality is not None:
+        encoding = dataclasses.replace(encoding, quality=quality)
+    if compress_level is not None:
+        encoding = dataclasses.replace(encoding, compress_level=compress_level)
+    return encoding
+
+
+async def detection_limits(
+    min_score: float = Form(0.0, description="最低置信度", ge=0.0, le=1.0),
+    max_objects: int = Form(
+        0, description="最多处理的对象数 (按置信度，0 表示不限)", ge=0
+    ),
+) -> dict:
+    return {"min_score": min_score, "max_objects": max_objects}
+
+
+async def save_crops(
+    crops: list[bytes], prefix: str, encoding: gen.Encoding = gen.PNG
+) -> list[str]:
+    """保存裁剪结果到结果存储，返回可通过 /result/{id} 下载的 id 列表"""
+    result_ids = [f"{prefix}_{i}" for i in range(len(crops))]
+    for result_id, crop in zip(result_ids, crops):
+        await asyncio.to_thread(
+            store.result_store.save,
+            result_id,
+            crop,
+            encoding.suffix,
+            encoding.media_type,
+        )
+    return result_ids
+
+
+def image_response(content: bytes, name: str, encoding: gen.Encoding) -> Response:
+    """以附件形式返回内存中的图片"""
+    return Response(
+        content,
+        media_type=encoding.media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="{name}{encoding.suffix}"',
+            "Vary": "Accept",
+        },
+    )
+
+
+async def stored_response(result_id: str) -> StreamingResponse:
+    """从结果存储流式返回一个结果，下载完成后按存储设置删除"""
+    result = await asyncio.to_thread(store.result_store.open, result_id)
+    if result is None:
         raise HTTPException(status_code=404, detail="文件未找到")
 
-    return FileResponse(
-        result_file,
-        filename=f"{id}.png",
+    headers = {"Content-Disposition": f'attachment; filename="{result.name}"'}
+    if result.size is not None:
+        headers["Content-Length"] = str(result.size)
+    return StreamingResponse(
+        result.chunks,
+        media_type=result.media_type,
+        headers=headers,
         background=BackgroundTasks(
-            [BackgroundTask(utils.cleanup_temp_file, [result_file])]
+            [BackgroundTask(store.result_store.downloaded, [result_id])]
         ),
     )
 
 
+def zip_response(result_ids: list[str], name: str) -> StreamingResponse:
+    """把多个结果打包为 zip 流返回，下载完成后按存储设置删除"""
+
+    def results():
+        # 逐个打开结果，同一时间只读取一个
+        for result_id in result_ids:
+            result = store.result_store.open(result_id)
+            if result is not None:
+                yield result.name, result.chunks
+
+    return StreamingResponse(
+        utils.stream_zip(results()),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{name}.zip"'},
+        background=BackgroundTask(store.result_store.downloaded, result_ids),
+    )
+
+
+def _pool_queue_depth() -> dict[tuple[str, ...], float]:
+    depths = {("crop",): gen.crop_pool._work_queue.qsize()}
+    executor = getattr(asyncio.get_running_loop(), "_default_executor", None)
+    if executor is not None:
+        depths[("default",)] = executor._work_queue.qsize()
+    return depths
+
+
+metrics.Callback(
+    "cut_thread_pool_queue_depth",
+    "Tasks waiting for a thread pool worker",
+    _pool_queue_depth,
+    labels=("pool",),
+)
+metrics.Callback(
+    "cut_detection_cache_events_total",
+    "Detection cache lookups and evictions",
+    lambda: {
+        (event,): cache.detection_cache.stats()[event]
+        for event in ("hits", "disk_hits", "misses", "evictions")
+    },
+    labels=("event",),
+    kind="counter",
+)
+metrics.Callback(
+    "cut_near_duplicate_events_total",
+    "Perceptual-hash lookups for resized or re-encoded uploads",
+    lambda: {
+        (event,): cache.near_duplicates.stats()[event]
+        for event in ("hits", "misses", "rejected", "evictions")
+    },
+    labels=("event",),
+    kind="counter",
+)
+metrics.Callback(
+    "cut_detection_cache_entries",
+    "Entries in the in-memory detection cache",
+    lambda: {(): cache.detection_cache.stats()["entries"]},
+)
+metrics.Callback(
+    "cut_scheduler_queue_depth",
+    "Images waiting in the inference scheduler",
+    lambda: (
+        {
+            (source,): model["queue_depth"]
+            for source, model in scheduler.inference_scheduler.stats()["models"].items()
+        }
+        if scheduler.inference_scheduler is not None
+        else {}
+    ),
+    labels=("model",),
+)
+metrics.Callback(
+    "cut_job_queue_depth",
+    "Jobs waiting in the job queue",
+    lambda: {(): jobs.job_queue.stats()["queue_depth"]},
+)
+metrics.Callback(
+    "cut_jobs_running",
+    "Jobs being processed",
+    lambda: {(): jobs.job_queue.running},
+)
+metrics.Callback(
+    "cut_admission_pixels_in_use",
+    "Pixels of images currently admitted for processing",
+    lambda: {(): admission.pixel_budget.in_use},
+)
+metrics.Callback(
+    "cut_admission_waiting",
+    "Requests waiting for pixel budget",
+    lambda: {(): admission.pixel_budget.waiting},
+)
+metrics.Callback(
+    "cut_admission_rejections_total",
+    "Requests rejected by admission control",
+    lambda: {
+        (reason,): admission.pixel_budget.stats()[reason]
+        for reason in ("rejected", "timeouts", "too_large")
+    },
+    labels=("reason",),
+    kind="counter",
+)
+
+
+@app.get("/metrics", description="Prometheus 格式的指标")
+async def prometheus_metrics():
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/health", description="存活检查")
+async def health():
+    return {"status": "ok"}
+
+
+@app.get("/ready", description="就绪检查，模型预热完成前返回 503")
+async def ready():
+    if not readiness["ready"]:
+        return JSONResponse(
+            {"ready": False, "error": readiness["error"]}, status_code=503
+        )
+    return {"ready": True, "models": readiness["models"]}
+
+
+@app.get(
+    "/cache/stats", description="检测结果缓存和近似重复图片索引的命中、未命中和淘汰统计"
+)
+async def cache_stats():
+    return {
+        **cache.detection_cache.stats(),
+        "near_duplicates": cache.near_duplicates.stats(),
+    }
+
+
+@app.get("/scheduler/stats", description="推理调度器的队列深度和批次统计")
+async def scheduler_stats():
+    if scheduler.inference_scheduler is None:
+        return {"enabled": False}
+    return {"enabled": True, **scheduler.inference_scheduler.stats()}
+
+
+@app.get("/admission/stats", description="像素预算的占用、排队和拒绝统计")
+async def admission_stats():
+    return admission.pixel_budget.stats()
+
+
+@app.get("/results/stats", description="生成结果存储的占用、过期和淘汰统计")
+async def result_stats():
+    return store.result_store.stats()
+
+
+@app.get("/result/{id}")
+async def download_result(id: str):
+    return await stored_response(id)
+
+
 @app.post("/cutone", description="从单个上传图像中生成指定对象的第一个正方形图片")
 async def cut_image(
     type: gen.GenSquareType = Form(
@@ -85,45 +551,28 @@ async def cut_image(
         ge=0.0,
         le=1.0,
     ),
+    encoding: gen.Encoding = Depends(output_encoding),
+    limits: dict = Depends(detection_limits),
 ):
-    if not file.content_type or not file.content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="文件类型不支持")
-
-    img_path = Path(tempfile.mktemp(suffix=".png", dir=INPUT_DIR))
+    content = await read_image(file)
     try:
-        content = await file.read()
-        if not content:
-            raise HTTPException(status_code=400, detail="文件内容为空")
-
-        if not img_path.parent.exists():
-            img_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(img_path, "wb") as f:
-            f.write(content)
-
-        avatars = await asyncio.to_thread(
-            gen.square,
-            type=gen.GenSquareType(type),
-            img_path=img_path,
-            output_dir=OUTPUT_DIR,
+        avatars = await generate(
+            "square",
+            gen.GenSquareType(type),
+            content,
             target_size=size,
             padding_ratio=padding,
+            encoding=encoding,
+            **limits,
         )
         if not avatars:
             raise HTTPException(status_code=500, detail="未检测到对象")
-        avatar = avatars[0]
-        return FileResponse(
-            avatar,
-            filename=f"{type}.png",
-            background=BackgroundTasks(
-                [BackgroundTask(utils.cleanup_temp_file, [img_path, *avatars])],
-            ),
-        )
+        return image_response(avatars[0], f"{type}", encoding)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"处理图片时发生错误: {str(e)}")
         raise HTTPException(status_code=500, detail=f"图片处理错误: {str(e)}")
-    finally:
-        if img_path.exists():
-            img_path.unlink(missing_ok=True)
 
 
 @app.post("/cutall", description="从单个上传图像中生成指定对象的所有正方形图片")
@@ -143,46 +592,287 @@ async def cut_all_images(
         ge=0.0,
         le=1.0,
     ),
+    encoding: gen.Encoding = Depends(output_encoding),
+    limits: dict = Depends(detection_limits),
 ):
-    if not file.content_type or not file.content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="文件类型不支持")
-
-    img_path = Path(tempfile.mktemp(suffix=".png", dir=INPUT_DIR))
+    content = await read_image(file)
     try:
-        content = await file.read()
-        if not content:
-            raise HTTPException(status_code=400, detail="文件内容为空")
-
-        if not img_path.parent.exists():
-            img_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(img_path, "wb") as f:
-            f.write(content)
-
-        avatars = await asyncio.to_thread(
-            gen.square,
-            type=gen.GenSquareType(type),
-            img_path=img_path,
-            output_dir=OUTPUT_DIR,
+        avatars = await generate(
+            "square",
+            gen.GenSquareType(type),
+            content,
             target_size=size,
             padding_ratio=padding,
+            encoding=encoding,
+            **limits,
         )
         if not avatars:
             raise HTTPException(status_code=500, detail="未检测到对象")
 
+        result_ids = await save_crops(avatars, f"{uuid.uuid4().hex}_{type}", encoding)
         return {
             "message": "生成成功",
             "count": len(avatars),
             "urls": [
-                f"{str(req.base_url).removesuffix('/')}/result/{avatar.stem}"
-                for avatar in avatars
+                f"{str(req.base_url).removesuffix('/')}/result/{result_id}"
+                for result_id in result_ids
             ],
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"处理图片时发生错误: {str(e)}")
         raise HTTPException(status_code=500, detail=f"图片处理错误: {str(e)}")
-    finally:
-        if img_path.exists():
-            img_path.unlink(missing_ok=True)
+
+
+@app.post(
+    "/cutmany", description="从单个上传图像中一次生成多个类型对象的所有正方形图片"
+)
+async def cut_many_images(
+    req: Request,
+    types: str = Form(
+        "head",
+        description="要生成的对象类型，多个类型用逗号分隔 (如 head,faces,eyes)",
+    ),
+    file: UploadFile = File(
+        ...,
+        description="上传的图片文件",
+    ),
+    size: int = Form(640, description="目标正方形边长 (像素)", ge=32),
+    padding: float = Form(
+        0.3,
+        description="对象周围的扩展比例 (0.3表示在对象基础上向外扩展30%)",
+        ge=0.0,
+        le=1.0,
+    ),
+    encoding: gen.Encoding = Depends(output_encoding),
+    limits: dict = Depends(detection_limits),
+):
+    cut_types = parse_types(types)
+    content = await read_image(file)
+    try:
+        async with admitted(content):
+            started = time.perf_counter()
+            image, detect_image, scale = await asyncio.to_thread(
+                utils.load_image, content, gen.MAX_DETECT_SIDE
+            )
+            decode_ms = (time.perf_counter() - started) * 1000
+
+            async def detect_group(members: list[gen.GenSquareType]):
+                # 互不相关的模型并发推理，共享模型的类型只推理一次
+                group_started = time.perf_counter()
+                grouped = await run_detection(members, detect_image)
+                grouped = {
+                    type: gen.scale_results(results, scale, image.size)
+                    for type, results in grouped.items()
+                }
+                return grouped, (time.perf_counter() - group_started) * 1000
+
+            async def crop(results):
+                crop_started = time.perf_counter()
+                crops = await asyncio.to_thread(
+                    gen.crop_squares, image, results, size, padding, encoding
+                )
+                return crops, (time.perf_counter() - crop_started) * 1000
+
+            detected: dict[gen.GenSquareType, tuple] = {}
+            for grouped, detect_ms in await asyncio.gather(
+                *(
+                    detect_group(members)
+                    for members in gen.group_types(cut_types).values()
+                )
+            ):
+                for type, results in grouped.items():
+                    detected[type] = (results, detect_ms)
+
+            # 并发裁剪前先完成原图解码
+            await asyncio.to_thread(image.load)
+            cropped = await asyncio.gather(
+                *(
+                    crop(geometry.select(detected[type][0], **limits) or [])
+                    for type in cut_types
+                )
+            )
+
+            stem = uuid.uuid4().hex
+            base_url = str(req.base_url).removesuffix("/")
+            results = {}
+            for type, (crops, crop_ms) in zip(cut_types, cropped):
+                result_ids = await save_crops(crops, f"{stem}_{type}", encoding)
+                results[type] = {
+                    "count": len(crops),
+                    "urls": [
+                        f"{base_url}/result/{result_id}" for result_id in result_ids
+                    ],
+                    "timings": {
+                        "detect_ms": round(detected[type][1], 2),
+                        "crop_ms": round(crop_ms, 2),
+                    },
+                }
+            return {
+                "message": "生成成功",
+                "count": sum(result["count"] for result in results.values()),
+                "results": results,
+                "timings": {
+                    "decode_ms": round(decode_ms, 2),
+                    "total_ms": round((time.perf_counter() - started) * 1000, 2),
+                },
+            }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"处理图片时发生错误: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"图片处理错误: {str(e)}")
+
+
+def batch_sources(files: list[UploadFile]):
+    """依次产出上传图片和 zip 压缩包内的图片，内容在处理时才读取"""
+    for file in files:
+        filename = file.filename or ""
+        if file.content_type in ("application/zip", "application/x-zip-compressed") or (
+            filename.lower().endswith(".zip")
+        ):
+            archive = zipfile.ZipFile(file.file)
+            try:
+                members = uploads.archive_members(archive)
+            except HTTPException as e:
+
+                async def rejected(error=e):
+                    raise error
+
+                yield filename, rejected
+                continue
+            for info in members:
+                # 每个成员绑定自己所在的压缩包，压缩包在成员读取前保持打开
+                yield (
+                    info.filename,
+                    lambda info=info, archive=archive: asyncio.to_thread(
+                        uploads.read_archive_member, archive, info
+                    ),
+                )
+        else:
+            yield filename, lambda file=file: read_image(file)
+
+
+@app.post(
+    "/cutbatch",
+    description="批量处理多张图片或 zip 压缩包，以 NDJSON 流式返回每张图片的结果",
+)
+async def cut_batch_images(
+    req: Request,
+    files: list[UploadFile] = File(
+        ...,
+        description="上传的图片文件或包含图片的 zip 压缩包",
+    ),
+    type: gen.GenSquareType = Form(
+        gen.GenSquareType.HEAD, description="要生成的对象类型"
+    ),
+    size: int = Form(640, description="目标正方形边长 (像素)", ge=32),
+    padding: float = Form(
+        0.3,
+        description="对象周围的扩展比例 (0.3表示在对象基础上向外扩展30%)",
+        ge=0.0,
+        le=1.0,
+    ),
+    encoding: gen.Encoding = Depends(output_encoding),
+    limits: dict = Depends(detection_limits),
+):
+    batch_id = uuid.uuid4().hex
+    base_url = str(req.base_url).removesuffix("/")
+
+    async def process(index: int, name: str, read) -> dict:
+        try:
+            content = await read()
+            if not content:
+                raise HTTPException(status_code=400, detail="文件内容为空")
+            avatars = await generate(
+                "square",
+                gen.GenSquareType(type),
+                content,
+                admission_timeout=None,
+                target_size=size,
+                padding_ratio=padding,
+                encoding=encoding,
+                **limits,
+            )
+            result_ids = await save_crops(
+                avatars or [], f"{batch_id}_{index}_{type}", encoding
+            )
+            return {
+                "index": index,
+                "name": name,
+                "count": len(result_ids),
+                "urls": [f"{base_url}/result/{result_id}" for result_id in result_ids],
+            }
+        except HTTPException as e:
+            return {"index": index, "name": name, "error": e.detail}
+        except Exception as e:
+            logger.error(f"处理图片 {name} 时发生错误: {str(e)}")
+            return {"index": index, "name": name, "error": f"图片处理错误: {str(e)}"}
+
+    async def stream():
+        images = 0
+        crops = 0
+        pending: set[asyncio.Task] = set()
+
+        def finish(done: set[asyncio.Task]):
+            nonlocal crops
+            for task in done:
+                line = task.result()
+                crops += line.get("count", 0)
+                yield json.dumps(line, ensure_ascii=False) + "\n"
+
+        try:
+            for index, (name, read) in enumerate(batch_sources(files)):
+                if len(pending) >= CUTBATCH_IN_FLIGHT:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for line in finish(done):
+                        yield line
+                pending.add(asyncio.create_task(process(index, name, read)))
+                images += 1
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for line in finish(done):
+                    yield line
+        except Exception as e:
+            logger.error(f"读取批量上传内容失败: {str(e)}")
+            yield (
+                json.dumps({"error": f"读取上传内容失败: {str(e)}"}, ensure_ascii=False)
+                + "\n"
+            )
+        finally:
+            for task in pending:
+                task.cancel()
+        yield (
+            json.dumps(
+                {
+                    "done": True,
+                    "images": images,
+                    "count": crops,
+                    "zip": f"{base_url}/cutbatch/{batch_id}.zip",
+                }
+            )
+            + "\n"
+        )
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@app.get(
+    "/cutbatch/{batch_id}.zip",
+    description="以 zip 流的形式下载一次批量处理生成的全部图片",
+)
+async def download_batch(batch_id: str):
+    if not re.fullmatch(r"[0-9a-f]{32}", batch_id):
+        raise HTTPException(status_code=404, detail="文件未找到")
+    result_ids = await asyncio.to_thread(store.result_store.find, f"{batch_id}_")
+    if not result_ids:
+        raise HTTPException(status_code=404, detail="文件未找到")
+    return zip_response(result_ids, batch_id)
 
 
 @app.post("/mask", description="标记识别到的对象区域")
@@ -211,36 +901,26 @@ async def mask_image(
         ge=1,
         le=32,
     ),
+    encoding: gen.Encoding = Depends(output_encoding),
+    limits: dict = Depends(detection_limits),
 ):
-    if not file.content_type or not file.content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="文件类型不支持")
-
+    content = await read_image(file)
     try:
-        content = await file.read()
-        if not content:
-            raise HTTPException(status_code=400, detail="文件内容为空")
-        img_path = Path(tempfile.mktemp(suffix=".png", dir=INPUT_DIR))
-        with open(img_path, "wb") as f:
-            f.write(content)
-        result = await asyncio.to_thread(
-            gen.mask,
-            type=gen.GenSquareType(type),
-            img_path=img_path,
-            output_dir=OUTPUT_DIR,
+        result = await generate(
+            "mask",
+            gen.GenSquareType(type),
+            content,
             padding_ratio=padding,
             color=color,
             width=width,
+            encoding=encoding,
+            **limits,
         )
         if not result:
             raise HTTPException(status_code=500, detail="标记生成失败")
-        return FileResponse(
-            result,
-            filename=f"{type}_mask.png",
-            background=BackgroundTasks(
-                [BackgroundTask(utils.cleanup_temp_file, [img_path, result])],
-            ),
-        )
-
+        return image_response(result, f"{type}_mask", encoding)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"处理图片时发生错误: {str(e)}")
         raise HTTPException(status_code=500, detail=f"图片处理错误: {str(e)}")
@@ -282,38 +962,180 @@ async def highlight_image(
         ge=1,
         le=32,
     ),
+    encoding: gen.Encoding = Depends(output_encoding),
+    limits: dict = Depends(detection_limits),
 ):
-    if not file.content_type or not file.content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="文件类型不支持")
-
+    content = await read_image(file)
     try:
-        content = await file.read()
-        if not content:
-            raise HTTPException(status_code=400, detail="文件内容为空")
-        img_path = Path(tempfile.mktemp(suffix=".png", dir=INPUT_DIR))
-        with open(img_path, "wb") as f:
-            f.write(content)
-        result = await asyncio.to_thread(
-            gen.highlight,
-            type=gen.GenSquareType(type),
-            img_path=img_path,
-            output_dir=OUTPUT_DIR,
+        result = await generate(
+            "highlight",
+            gen.GenSquareType(type),
+            content,
             padding_ratio=padding,
             blur_radius=blur_radius,
             with_mask=with_mask,
             mask_color=mask_color,
             mask_width=mask_width,
+            encoding=encoding,
+            **limits,
         )
         if not result:
             raise HTTPException(status_code=500, detail="高亮生成失败")
-        return FileResponse(
-            result,
-            filename=f"{type}_highlight.png",
-            background=BackgroundTasks(
-                [BackgroundTask(utils.cleanup_temp_file, [img_path, result])],
-            ),
+        return image_response(result, f"{type}_highlight", encoding)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"处理图片时发生错误: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"图片处理错误: {str(e)}")
+
+
+@app.post(
+    "/cutclip",
+    description="从动图 (GIF/WebP/APNG) 或短视频中跟踪对象，为每个对象生成稳定的裁剪动画或图片",
+)
+async def cut_clip(
+    req: Request,
+    type: gen.GenSquareType = Form(
+        gen.GenSquareType.HEAD, description="要生成的对象类型"
+    ),
+    file: UploadFile = File(
+        ...,
+        description="上传的动图或视频文件 (MP4/WebM/AVI)",
+    ),
+    size: int = Form(
+        320, description="目标正方形边长 (像素)", ge=32, le=video.CLIP_MAX_SIZE
+    ),
+    padding: float = Form(
+        0.3,
+        description="对象周围的扩展比例 (0.3表示在对象基础上向外扩展30%)",
+        ge=0.0,
+        le=1.0,
+    ),
+    fps: float = Form(10, description="采样帧率", gt=0, le=30),
+    keyframe_interval: int = Form(
+        5, description="每隔多少个采样帧运行一次检测，其余帧插值", ge=1, le=30
+    ),
+    animate: bool = Form(
+        True, description="为每个对象输出裁剪动画，否则输出置信度最高的一帧"
+    ),
+    encoding: gen.Encoding = Depends(output_encoding),
+):
+    content = await read_image(file, allow_video=True)
+    try:
+        clip = await asyncio.to_thread(video.Clip, content)
+    except Exception:
+        raise HTTPException(status_code=400, detail="无法识别的动图或视频")
+    try:
+        # 单帧按图片上限检查，流水线中同时存在的原始帧不超过一个关键帧间隔，
+        # 另外计入跟踪对象缓存的裁剪帧
+        async with admit_pixels(
+            clip.width * clip.height,
+            count=keyframe_interval + 1,
+            extra=video.crop_budget(size, animate=animate),
+        ):
+            # 关键帧检测在跟踪过程中进行，整个流程在检测线程池中运行
+            outputs = await in_detect_pool(
+                video.track_squares,
+                gen.GenSquareType(type),
+                clip,
+                target_size=size,
+                padding_ratio=padding,
+                fps=fps,
+                keyframe_interval=keyframe_interval,
+                animate=animate,
+                encoding=encoding,
+            )
+        if not outputs:
+            raise HTTPException(status_code=500, detail="未检测到对象")
+        if animate:
+            encoding = video.animation_encoding(encoding)
+        result_ids = await save_crops(outputs, f"{uuid.uuid4().hex}_{type}", encoding)
+        return {
+            "message": "生成成功",
+            "count": len(outputs),
+            "urls": [
+                f"{str(req.base_url).removesuffix('/')}/result/{result_id}"
+                for result_id in result_ids
+            ],
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"处理动图或视频时发生错误: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"图片处理错误: {str(e)}")
+    finally:
+        await asyncio.to_thread(clip.close)
+
+
+def detection_json(
+    results: list[Detection] | None,
+    image_size: tuple[int, int],
+    padding: float | None = None,
+    size: int | None = None,
+) -> list[dict]:
+    """检测结果的 JSON 表示
+
+    给出 ``padding`` 或 ``size`` 时附带与 /cutall 相同的正方形裁剪区域
+    ``window``，给出 ``size`` 时还附带把裁剪区域缩放到目标边长的比例 ``scale``。
+    """
+    objects = [
+        {"box": list(box), "label": label, "score": score}
+        for box, label, score in results or []
+    ]
+    if objects and (padding is not None or size is not None):
+        windows = geometry.square_windows(
+            geometry.boxes_of(results), image_size, 0.3 if padding is None else padding
         )
+        for item, window in zip(objects, windows.tolist()):
+            item["window"] = window
+            if size is not None:
+                item["scale"] = round(size / max(1, window[2] - window[0]), 6)
+    return objects
+
 
+@app.post(
+    "/detect",
+    description="检测多个类型的对象并按类型分组返回坐标，可同时返回正方形裁剪区域，不生成图片",
+)
+async def detect_objects(
+    file: UploadFile = File(
+        ...,
+        description="上传的图片文件",
+    ),
+    types: str = Form(
+        "head",
+        description="要检测的对象类型，多个类型用逗号分隔 (如 armpits,feet)",
+    ),
+    padding: float | None = Form(
+        None,
+        description="给出时返回每个对象的正方形裁剪区域，对象周围的扩展比例同 /cutall (默认 0.3)",
+        ge=0.0,
+        le=1.0,
+    ),
+    size: int | None = Form(
+        None,
+        description="目标正方形边长，给出时返回裁剪区域及其缩放比例",
+        ge=32,
+    ),
+    limits: dict = Depends(detection_limits),
+):
+    detect_types = parse_types(types)
+    content = await read_image(file)
+    try:
+        async with admitted(content):
+            image, grouped = await load_and_detect(detect_types, content)
+        return {
+            "width": image.width,
+            "height": image.height,
+            "results": {
+                type: detection_json(
+                    geometry.select(results, **limits), image.size, padding, size
+                )
+                for type, results in grouped.items()
+            },
+        }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"处理图片时发生错误: {str(e)}")
         raise HTTPException(status_code=500, detail=f"图片处理错误: {str(e)}")
@@ -333,42 +1155,159 @@ async def cut_avatar(
         ge=0.0,
         le=1.0,
     ),
+    encoding: gen.Encoding = Depends(output_encoding),
+    limits: dict = Depends(detection_limits),
 ):
-    if not file.content_type or not file.content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="文件类型不支持")
-
+    content = await read_image(file)
     try:
-        content = await file.read()
-        if not content:
-            raise HTTPException(status_code=400, detail="文件内容为空")
-
-        img_path = Path(tempfile.mktemp(suffix=".png", dir=INPUT_DIR))
-        with open(img_path, "wb") as f:
-            f.write(content)
-        avatars = await asyncio.to_thread(
-            gen.square,
-            type=gen.GenSquareType.HEAD,
-            img_path=img_path,
-            output_dir=OUTPUT_DIR,
+        avatars = await generate(
+            "square",
+            gen.GenSquareType.HEAD,
+            content,
             target_size=size,
             padding_ratio=padding,
+            encoding=encoding,
+            **limits,
         )
         if not avatars:
             raise HTTPException(status_code=500, detail="头像生成失败")
-        avatar = avatars[0]
-        return FileResponse(
-            avatar,
-            filename="avatar.png",
-            background=BackgroundTasks(
-                [BackgroundTask(utils.cleanup_temp_file, [img_path, *avatars])],
-            ),
-        )
-
+        return image_response(avatars[0], "avatar", encoding)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"处理图片时发生错误: {str(e)}")
         raise HTTPException(status_code=500, detail=f"图片处理错误: {str(e)}")
 
 
+@app.post(
+    "/jobs",
+    status_code=202,
+    description="提交异步任务，立即返回任务 id，通过 /jobs/{job_id} 查询进度",
+)
+async def submit_job(
+    req: Request,
+    file: UploadFile = File(
+        ...,
+        description="上传的图片文件",
+    ),
+    kind: str = Form(
+        "square",
+        description="任务类型: square (生成所有正方形图片)、mask 或 highlight",
+    ),
+    type: gen.GenSquareType = Form(
+        gen.GenSquareType.HEAD,
+        description="要处理的对象类型",
+    ),
+    size: int = Form(640, description="square: 目标正方形边长 (像素)", ge=32),
+    padding: float | None = Form(
+        None,
+        description="对象周围的扩展比例，默认与同步接口一致",
+        ge=0.0,
+        le=1.0,
+    ),
+    blur_radius: float = Form(
+        15.0, description="highlight: 高亮模糊半径 (像素)", ge=0.0, le=100.0
+    ),
+    with_mask: bool = Form(False, description="highlight: 是否同时生成遮罩"),
+    color: str = Form("red", description="mask / highlight: 标记颜色"),
+    width: int = Form(8, description="mask / highlight: 标记线条宽度", ge=1, le=32),
+    priority: int = Form(0, description="优先级，数值大的任务先执行"),
+    callback_url: str | None = Form(
+        None, description="任务完成后以 POST 推送任务状态的地址"
+    ),
+    encoding: gen.Encoding = Depends(output_encoding),
+    limits: dict = Depends(detection_limits),
+):
+    if kind not in gen.generators:
+        raise HTTPException(status_code=400, detail=f"不支持的任务类型: {kind}")
+    if callback_url:
+        try:
+            await jobs.check_callback_url(callback_url)
+        except jobs.CallbackError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    if kind == "square":
+        kwargs = dict(
+            target_size=size, padding_ratio=0.3 if padding is None else padding
+        )
+    elif kind == "mask":
+        kwargs = dict(
+            padding_ratio=0.2 if padding is None else padding, color=color, width=width
+        )
+    else:
+        kwargs = dict(
+            padding_ratio=0.2 if padding is None else padding,
+            blur_radius=blur_radius,
+            with_mask=with_mask,
+            mask_color=color,
+            mask_width=width,
+        )
+    content = await read_image(file)
+    # 超过单张像素上限的图片在提交时拒绝，像素预算在执行时等待
+    image_pixels(content)
+    stem = uuid.uuid4().hex
+
+    async def run() -> list[str]:
+        output = await generate(
+            kind,
+            type,
+            content,
+            admission_timeout=None,
+            encoding=encoding,
+            **limits,
+            **kwargs,
+        )
+        outputs = output if kind == "square" else [output] if output else []
+        return await save_crops(outputs or [], f"{stem}_{type}", encoding)
+
+    try:
+        job = jobs.job_queue.submit(
+            kind,
+            run,
+            priority=priority,
+            base_url=str(req.base_url).removesuffix("/"),
+            callback_url=callback_url,
+        )
+    except jobs.QueueFullError as e:
+        raise HTTPException(
+            status_code=503, detail=str(e), headers={"Retry-After": "1"}
+        )
+    return {**job.to_dict(), "status_url": f"{job.base_url}/jobs/{job.id}"}
+
+
+@app.get("/jobs/stats", description="任务队列的深度、等待时间和完成统计")
+async def job_stats():
+    return jobs.job_queue.stats()
+
+
+@app.get("/jobs/{job_id}", description="查询异步任务的状态和结果地址")
+async def job_status(job_id: str):
+    job = jobs.job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job.to_dict()
+
+
+@app.get(
+    "/jobs/{job_id}/result",
+    description="下载任务结果，单个结果直接返回图片，多个结果打包为 zip；未完成时返回 202",
+)
+async def job_result(job_id: str):
+    job = jobs.job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    if not job.done:
+        return JSONResponse(
+            job.to_dict(), status_code=202, headers={"Retry-After": "1"}
+        )
+    if job.status == jobs.JobStatus.FAILED:
+        raise HTTPException(status_code=500, detail=job.error)
+    if not job.result_ids:
+        raise HTTPException(status_code=404, detail="未检测到对象")
+    if len(job.result_ids) == 1:
+        return await stored_response(job.result_ids[0])
+    return zip_response(job.result_ids, job.id)
+
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -0,0 +1,312 @@
+import math
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+# 耗时直方图的默认分桶 (秒)
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+registry: list["_Metric"] = []
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\""),
+        )
+        for name, value in zip(names, values)
+    )
+    return f"{{{pairs}}}"
+
+
+class _Metric:
+    """Prometheus 文本格式的指标"""
+
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def collect(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.kind}",
+            *self.samples(),
+        ]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        self._values: dict[tuple[str, ...], tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = [
+                (key, list(counts), total, count)
+                for key, (counts, total, count) in self._values.items()
+            ]
+        for key, counts, total, count in values:
+            for bound, bucket_count in zip((*self.buckets, math.inf), (*counts, count)):
+                labels = _format_labels(
+                    (*self.labels, "le"), (*key, _format_value(bound))
+                )
+                yield f"{self.name}_bucket{labels} {bucket_count}"
+            labels = _format_labels(self.labels, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class Callback(_Metric):
+    """抓取时由回调函数提供取值的指标，回调返回 {标签值元组: 值}"""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        func: Callable[[], dict[tuple[str, ...], float]],
+        labels: tuple[str, ...] = (),
+        kind: str = "gauge",
+    ):
+        super().__init__(name, help, labels)
+        self.func = func
+        self.kind = kind
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self.func().items():
+            yield f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+
+
+def render() -> str:
+    """以 Prometheus 文本格式输出所有指标"""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "cut_stage_seconds",
+    "Time spent in each processing stage",
+    labels=("stage", "type"),
+)
+DETECTIONS = Histogram(
+    "cut_detections_per_image",
+    "Objects detected per image",
+    labels=("type",),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50),
+)
+REQUESTS = Counter(
+    "cut_http_requests_total", "HTTP requests", labels=("route", "status")
+)
+REQUEST_SECONDS = Histogram(
+    "cut_http_request_seconds",
+    "Time until the response headers were sent",
+    labels=("route",),
+)
+IN_FLIGHT = Gauge("cut_http_requests_in_flight", "HTTP requests being processed")
+
+
+@dataclass
+class Trace:
+    """单个请求内各阶段的耗时和检测数量，用于 Server-Timing 头和跨进程汇总"""
+
+    stages: list[tuple[str, str, float]] = field(default_factory=list)
+    detections: list[tuple[str, int]] = field(default_factory=list)
+
+
+_trace: ContextVar[Trace | None] = ContextVar("trace", default=None)
+
+
+def record_stage(stage: str, seconds: float, type: str = "") -> None:
+    STAGE_SECONDS.observe(seconds, stage=stage, type=type)
+    trace = _trace.get()
+    if trace is not None:
+        trace.stages.append((stage, type, seconds))
+
+
+@contextmanager
+def stage(name: str, type: str = "") -> Iterator[None]:
+    """记录代码块的耗时"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started, type)
+
+
+def record_detections(type: str, count: int) -> None:
+    DETECTIONS.observe(count, type=type)
+    trace = _trace.get()
+    if trace is not None:
+        trace.detections.append((type, count))
+
+
+@contextmanager
+def collect() -> Iterator[Trace]:
+    """在当前上下文中收集阶段耗时，供工作进程把结果带回主进程"""
+    trace = Trace()
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+
+
+def merge(trace: Trace) -> None:
+    """把工作进程中收集的耗时和检测数量记录到当前进程"""
+    for stage_name, type, seconds in trace.stages:
+        record_stage(stage_name, seconds, type)
+    for type, count in trace.detections:
+        record_detections(type, count)
+
+
+def server_timing(trace: Trace, total: float) -> str:
+    """生成 Server-Timing 头，同一阶段的多次耗时合并"""
+    durations: dict[tuple[str, str], float] = {}
+    for stage_name, type, seconds in trace.stages:
+        key = (stage_name, type)
+        durations[key] = durations.get(key, 0) + seconds
+    entries = [
+        f'{stage_name};desc="{type}";dur={seconds * 1000:.2f}'
+        if type
+        else f"{stage_name};dur={seconds * 1000:.2f}"
+        for (stage_name, type), seconds in durations.items()
+    ]
+    entries.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(entries)
+
+
+class MetricsMiddleware:
+    """统计请求数、耗时和并发量，并在响应头中附加 Server-Timing
+
+    Server-Timing 只包含响应头发出前的阶段，发送响应体的耗时记为
+    ``response`` 阶段，只出现在 /metrics 中。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        trace = Trace()
+        token = _trace.set(trace)
+        started = time.perf_counter()
+        response_started: float | None = None
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal response_started, status
+            if message["type"] == "http.response.start":
+                response_started = time.perf_counter()
+                status = message["status"]
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (
+                        b"server-timing",
+                        server_timing(trace, response_started - started).encode(),
+                    ),
+                ]
+            elif message["type"] == "http.response.body" and not message.get(
+                "more_body", False
+            ):
+                if response_started is not None:
+                    record_stage("response", time.perf_counter() - response_started)
+            await send(message)
+
+        IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            IN_FLIGHT.dec()
+            _trace.reset(token)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUESTS.inc(route=route, status=str(status))
+            REQUEST_SECONDS.observe(
+                (response_started or time.perf_counter()) - started, route=route
+            )
@@ -0,0 +1,182 @@
+import asyncio
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from loguru import logger
+from PIL import Image
+
+import gen
+import metrics
+from detect import Detection
+
+
+class QueueFullError(Exception):
+    """推理队列已满"""
+
+
+@dataclass
+class _Pending:
+    image: Image.Image
+    future: asyncio.Future
+    # 提交请求时的上下文，推理在其中运行以便阶段耗时记入该请求
+    context: contextvars.Context
+
+
+@dataclass
+class _ModelQueue:
+    queue: asyncio.Queue
+    executor: ThreadPoolExecutor
+    worker: asyncio.Task | None = None
+    batches: int = 0
+    images: int = 0
+    max_batch_seen: int = 0
+    rejected: int = 0
+
+
+class InferenceScheduler:
+    """把每个模型固定在一个推理线程上的调度器
+
+    imgutils 按线程缓存 ONNX 会话，调度器为每个模型分配一个队列和一个专用
+    推理线程，每个模型只在该线程上创建一份会话，请求依次推理。推理线程空闲时
+    立即处理新请求；推理期间到达的请求 (最多 ``max_batch`` 个) 在下一轮一起
+    取出，其中内容相同的图片只推理一次。imgutils 的检测器一次只接受一张图片，
+    因此这不是合并为一次 ONNX 调用的批量推理。队列长度超过 ``max_queue`` 时
+    直接拒绝。
+    """
+
+    def __init__(self, max_batch: int = 8, max_queue: int = 64):
+        self.max_batch = max_batch
+        self.max_queue = max_queue
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._models: dict[gen.GenSquareType, _ModelQueue] = {}
+
+    def _model(self, source: gen.GenSquareType) -> _ModelQueue:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # 事件循环变化 (如重启服务) 时丢弃旧的队列
+            self.close()
+            self._loop = loop
+        model = self._models.get(source)
+        if model is None:
+            model = _ModelQueue(
+                queue=asyncio.Queue(),
+                executor=ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix=f"infer-{source}"
+                ),
+            )
+            model.worker = loop.create_task(self._work(source, model))
+            self._models[source] = model
+        return model
+
+    async def _collect(self, model: _ModelQueue) -> list[_Pending]:
+        """取出队首请求和已在排队的请求，不等待后续请求到达"""
+        batch = [await model.queue.get()]
+        while len(batch) < self.max_batch and not model.queue.empty():
+            batch.append(model.queue.get_nowait())
+        return batch
+
+    async def _work(self, source: gen.GenSquareType, model: _ModelQueue) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect(model)
+            batch = [item for item in batch if not item.future.done()]
+            if not batch:
+                continue
+            model.batches += 1
+            model.images += len(batch)
+            model.max_batch_seen = max(model.max_batch_seen, len(batch))
+            try:
+                outputs = await loop.run_in_executor(
+                    model.executor,
+                    gen.detect_batch,
+                    source,
+                    [item.image for item in batch],
+                    [item.context for item in batch],
+                )
+            except Exception as e:
+                logger.error(f"批量推理失败: {str(e)}")
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_exception(e)
+                continue
+            for item, results in zip(batch, outputs):
+                if not item.future.done():
+                    item.future.set_result(results)
+
+    async def _submit(
+        self, source: gen.GenSquareType, image: Image.Image
+    ) -> list[Detection]:
+        model = self._model(source)
+        if model.queue.qsize() >= self.max_queue:
+            model.rejected += 1
+            raise QueueFullError(f"{source} 推理队列已满")
+        future = asyncio.get_running_loop().create_future()
+        model.queue.put_nowait(
+            _Pending(image=image, future=future, context=contextvars.copy_context())
+        )
+        # 排队和推理的总耗时，推理本身在推理线程中记为 detect 阶段
+        with metrics.stage("batch", source):
+            return await future
+
+    async def detect_many(
+        self, types: list[gen.GenSquareType], image: Image.Image
+    ) -> dict[gen.GenSquareType, list[Detection] | None]:
+        """检测多个类型，不同模型的请求并发排队"""
+        groups = gen.group_types(types)
+        outputs = await asyncio.gather(
+            *(self._submit(source, image) for source in groups)
+        )
+        grouped: dict[gen.GenSquareType, list[Detection] | None] = {}
+        for members, results in zip(groups.values(), outputs):
+            for type in members:
+                grouped[type] = gen.view(type, results)
+        return grouped
+
+    async def warm_up(
+        self, types: list[gen.GenSquareType]
+    ) -> dict[gen.GenSquareType, float]:
+        """在各模型的推理线程上预热模型，返回每个模型的耗时 (毫秒)"""
+        loop = asyncio.get_running_loop()
+        timings: dict[gen.GenSquareType, float] = {}
+        for source in gen.group_types(types):
+            timings |= await loop.run_in_executor(
+                self._model(source).executor, gen.warm_up, [source]
+            )
+        return timings
+
+    def stats(self) -> dict:
+        return {
+            "max_batch": self.max_batch,
+            "max_queue": self.max_queue,
+            "models": {
+                source: {
+                    "queue_depth": model.queue.qsize(),
+                    "batches": model.batches,
+                    "images": model.images,
+                    "max_batch": model.max_batch_seen,
+                    "rejected": model.rejected,
+                }
+                for source, model in self._models.items()
+            },
+        }
+
+    def close(self) -> None:
+        for model in self._models.values():
+            if model.worker is not None and not model.worker.get_loop().is_closed():
+                model.worker.cancel()
+            model.executor.shutdown(wait=False, cancel_futures=True)
+        self._models.clear()
+
+
+def from_env() -> InferenceScheduler | None:
+    """由环境变量创建调度器，未设置 INFERENCE_SCHEDULER 时不启用"""
+    if os.getenv("INFERENCE_SCHEDULER", "").lower() not in ("1", "true", "yes"):
+        return None
+    return InferenceScheduler(
+        max_batch=int(os.getenv("BATCH_MAX_SIZE", 8)),
+        max_queue=int(os.getenv("BATCH_MAX_QUEUE", 64)),
+    )
+
+
+inference_scheduler = from_env()
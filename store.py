@@ -0,0 +1,557 @@
+import abc
+import hashlib
+import hmac
+import mimetypes
+import os
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from collections import OrderedDict
+from collections.abc import Iterator
+from dataclasses import dataclass
+from datetime import UTC, datetime
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import BinaryIO
+from urllib.parse import quote
+
+import httpx
+from loguru import logger
+
+import utils
+
+OUTPUT_DIR = Path(__file__).parent / "output"
+# 旧版本保存上传图片的目录，现已不再写入，只由清理任务删除残留文件
+LEGACY_INPUT_DIR = Path(__file__).parent / "input"
+# 下载结果时每次读取的数据块大小
+CHUNK_SIZE = 1 << 16
+
+
+@dataclass
+class StoredResult:
+    """可流式读取的生成结果"""
+
+    name: str
+    media_type: str | None
+    size: int | None
+    chunks: Iterator[bytes]
+
+
+def _read_file(source: BinaryIO) -> Iterator[bytes]:
+    try:
+        while chunk := source.read(CHUNK_SIZE):
+            yield chunk
+    finally:
+        source.close()
+
+
+def _read_bytes(data: bytes) -> Iterator[bytes]:
+    view = memoryview(data)
+    for start in range(0, len(view), CHUNK_SIZE):
+        yield bytes(view[start : start + CHUNK_SIZE])
+
+
+class ResultStore(abc.ABC):
+    """生成结果存储的接口
+
+    ``ttl`` 为 0 时结果不过期，``multi_download`` 为 False 时结果在第一次
+    下载后删除。``sweep`` 由后台任务每隔 ``sweep_interval`` 秒调用一次。
+    """
+
+    backend = ""
+
+    def __init__(
+        self,
+        ttl: float = 3600,
+        multi_download: bool = False,
+        sweep_interval: float = 60,
+    ):
+        self.ttl = ttl
+        self.multi_download = multi_download
+        self.sweep_interval = sweep_interval
+        self.expired = 0
+
+    def _expires(self, created: float) -> float:
+        return created + self.ttl if self.ttl > 0 else float("inf")
+
+    @abc.abstractmethod
+    def save(self, id: str, content: bytes, suffix: str, media_type: str) -> None:
+        """保存生成的图片"""
+
+    @abc.abstractmethod
+    def open(self, id: str) -> StoredResult | None:
+        """打开结果用于流式读取，不存在或已过期时返回 None"""
+
+    @abc.abstractmethod
+    def find(self, prefix: str) -> list[str]:
+        """按 id 前缀查询所有未过期的结果"""
+
+    @abc.abstractmethod
+    def remove(self, ids: list[str]) -> None:
+        """删除结果，不存在的 id 忽略"""
+
+    def sweep(self) -> int:
+        """删除过期的结果，返回删除的数量"""
+        return 0
+
+    def downloaded(self, ids: list[str]) -> None:
+        """结果下载完成后调用，未开启多次下载时删除结果"""
+        if not self.multi_download:
+            self.remove(ids)
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend,
+            "ttl": self.ttl,
+            "multi_download": self.multi_download,
+            "expired": self.expired,
+        }
+
+
+@dataclass
+class _Entry:
+    name: str
+    media_type: str | None
+    size: int
+    expires: float
+    data: Path | bytes
+
+
+class _IndexedResultStore(ResultStore):
+    """在进程内维护结果索引的存储，支持总大小上限 (LRU 淘汰)
+
+    ``max_bytes`` 为 0 时不限制总大小。
+    """
+
+    def __init__(self, max_bytes: int = 0, **kwargs):
+        super().__init__(**kwargs)
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @abc.abstractmethod
+    def _write(self, name: str, content: bytes) -> Path | bytes:
+        """写入结果内容，返回保存在索引中的文件路径或数据"""
+
+    @abc.abstractmethod
+    def _read(self, entry: _Entry) -> Iterator[bytes]:
+        """按块读取结果内容"""
+
+    def _delete(self, entries: list[_Entry]) -> None:
+        pass
+
+    def _evict(self) -> list[_Entry]:
+        """超过总大小上限时按最近最少使用的顺序淘汰，需持有锁调用"""
+        evicted = []
+        while self.max_bytes > 0 and self.total_bytes > self.max_bytes:
+            if len(self._entries) <= 1:
+                break
+            _, entry = self._entries.popitem(last=False)
+            self.total_bytes -= entry.size
+            self.evictions += 1
+            evicted.append(entry)
+        return evicted
+
+    def _pop(self, ids: list[str]) -> list[_Entry]:
+        entries = []
+        for id in ids:
+            entry = self._entries.pop(id, None)
+            if entry is not None:
+                self.total_bytes -= entry.size
+                entries.append(entry)
+        return entries
+
+    def save(self, id: str, content: bytes, suffix: str, media_type: str) -> None:
+        name = f"{id}{suffix}"
+        data = self._write(name, content)
+        with self._lock:
+            replaced = self._pop([id])
+            self._entries[id] = _Entry(
+                name, media_type, len(content), self._expires(time.time()), data
+            )
+            self.total_bytes += len(content)
+            evicted = self._evict()
+        self._delete([entry for entry in replaced + evicted if entry.data != data])
+
+    def open(self, id: str) -> StoredResult | None:
+        with self._lock:
+            entry = self._entries.get(id)
+            if entry is None:
+                return None
+            if entry.expires <= time.time():
+                expired = self._pop([id])
+                self.expired += 1
+            else:
+                self._entries.move_to_end(id)
+                expired = []
+        if expired:
+            self._delete(expired)
+            return None
+        try:
+            chunks = self._read(entry)
+        except FileNotFoundError:
+            return None
+        return StoredResult(entry.name, entry.media_type, entry.size, chunks)
+
+    def find(self, prefix: str) -> list[str]:
+        now = time.time()
+        with self._lock:
+            return sorted(
+                id
+                for id, entry in self._entries.items()
+                if id.startswith(prefix) and entry.expires > now
+            )
+
+    def remove(self, ids: list[str]) -> None:
+        with self._lock:
+            entries = self._pop(ids)
+        self._delete(entries)
+
+    def _sweep_expired(self) -> list[_Entry]:
+        now = time.time()
+        with self._lock:
+            expired = self._pop(
+                [id for id, entry in self._entries.items() if entry.expires <= now]
+            )
+            self.expired += len(expired)
+        self._delete(expired)
+        return expired
+
+    def sweep(self) -> int:
+        expired = self._sweep_expired()
+        if expired:
+            logger.info(f"已清理 {len(expired)} 个过期结果")
+        return len(expired)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **super().stats(),
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+            }
+
+
+class LocalResultStore(_IndexedResultStore):
+    """保存在本地目录中的结果，只能由写入它的实例提供下载"""
+
+    backend = "local"
+
+    def __init__(self, root: Path, orphan_dirs: tuple[Path, ...] = (), **kwargs):
+        super().__init__(**kwargs)
+        self.root = root
+        self.orphan_dirs = orphan_dirs
+        if not root.exists():
+            root.mkdir(parents=True, exist_ok=True)
+        self._adopt()
+
+    def _adopt(self) -> None:
+        """接管重启前留下的结果文件，按修改时间计算过期时间"""
+        files = []
+        for path in self.root.iterdir():
+            if not path.is_file() or path.suffix == ".tmp":
+                continue
+            stat = path.stat()
+            files.append((stat.st_mtime, path, stat.st_size))
+        for mtime, path, size in sorted(files):
+            media_type, _ = mimetypes.guess_type(path.name)
+            self._entries[path.stem] = _Entry(
+                path.name, media_type, size, self._expires(mtime), path
+            )
+            self.total_bytes += size
+        self._delete(self._evict())
+
+    def _write(self, name: str, content: bytes) -> Path:
+        path = self.root / name
+        tmp_path = path.with_suffix(f"{path.suffix}.tmp")
+        tmp_path.write_bytes(content)
+        os.replace(tmp_path, path)
+        logger.info(f"图片已保存到: {path}")
+        return path
+
+    def _read(self, entry: _Entry) -> Iterator[bytes]:
+        assert isinstance(entry.data, Path)
+        return _read_file(entry.data.open("rb"))
+
+    def _delete(self, entries: list[_Entry]) -> None:
+        utils.cleanup_temp_file([entry.data for entry in entries])
+
+    def sweep(self) -> int:
+        """删除过期结果和遗留的孤立文件，返回删除的文件数"""
+        with self._lock:
+            known = {entry.data for entry in self._entries.values()}
+        expired = self._sweep_expired()
+        now = time.time()
+        orphans = []
+        max_age = self.ttl if self.ttl > 0 else 3600
+        for directory in (self.root, *self.orphan_dirs):
+            if not directory.is_dir():
+                continue
+            for path in directory.iterdir():
+                try:
+                    if (
+                        path.is_file()
+                        and path not in known
+                        and now - path.stat().st_mtime > max_age
+                    ):
+                        orphans.append(path)
+                except FileNotFoundError:
+                    continue
+        utils.cleanup_temp_file(orphans)
+        if expired or orphans:
+            logger.info(f"已清理 {len(expired)} 个过期结果和 {len(orphans)} 个孤立文件")
+        return len(expired) + len(orphans)
+
+    def stats(self) -> dict:
+        return {**super().stats(), "root": str(self.root)}
+
+
+class MemoryResultStore(_IndexedResultStore):
+    """保存在进程内存中的结果，适合单实例或测试环境"""
+
+    backend = "memory"
+
+    def _write(self, name: str, content: bytes) -> bytes:
+        return content
+
+    def _read(self, entry: _Entry) -> Iterator[bytes]:
+        assert isinstance(entry.data, bytes)
+        return _read_bytes(entry.data)
+
+
+class S3ResultStore(ResultStore):
+    """保存在 S3 兼容对象存储 (AWS S3、MinIO 等) 中的结果，任意实例都可以提供下载
+
+    使用路径风格的地址 (``{endpoint}/{bucket}/{key}``) 和 SigV4 签名，
+    过期时间按对象的 Last-Modified 计算，总大小由存储桶自身的策略管理。
+    """
+
+    backend = "s3"
+
+    def __init__(
+        self,
+        endpoint: str,
+        bucket: str,
+        access_key: str,
+        secret_key: str,
+        region: str = "us-east-1",
+        prefix: str = "",
+        transport: httpx.BaseTransport | None = None,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.endpoint = endpoint.rstrip("/")
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix
+        # transport 可替换为测试用的模拟对象存储
+        self.client = httpx.Client(timeout=30, transport=transport)
+
+    def _sign(
+        self, method: str, url: httpx.URL, headers: dict[str, str], payload_hash: str
+    ) -> dict[str, str]:
+        """按 AWS Signature Version 4 为请求签名"""
+        amz_date = datetime.now(UTC).strftime("%Y%m%dT%H%M%SZ")
+        scope = f"{amz_date[:8]}/{self.region}/s3/aws4_request"
+        headers = {
+            **{name.lower(): value.strip() for name, value in headers.items()},
+            "host": url.netloc.decode(),
+            "x-amz-content-sha256": payload_hash,
+            "x-amz-date": amz_date,
+        }
+        signed_headers = ";".join(sorted(headers))
+        canonical_request = "\n".join(
+            [
+                method,
+                url.raw_path.decode().split("?", 1)[0],
+                url.query.decode(),
+                "".join(f"{name}:{headers[name]}\n" for name in sorted(headers)),
+                signed_headers,
+                payload_hash,
+            ]
+        )
+        string_to_sign = "\n".join(
+            [
+                "AWS4-HMAC-SHA256",
+                amz_date,
+                scope,
+                hashlib.sha256(canonical_request.encode()).hexdigest(),
+            ]
+        )
+        key = f"AWS4{self.secret_key}".encode()
+        for part in (amz_date[:8], self.region, "s3", "aws4_request"):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        headers["authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+            f"SignedHeaders={signed_headers}, Signature={signature}"
+        )
+        return headers
+
+    def _request(
+        self,
+        method: str,
+        key: str = "",
+        params: dict[str, str] | None = None,
+        content: bytes = b"",
+        headers: dict[str, str] | None = None,
+        stream: bool = False,
+    ) -> httpx.Response:
+        query = "&".join(
+            f"{quote(name, safe='-_.~')}={quote(value, safe='-_.~')}"
+            for name, value in sorted((params or {}).items())
+        )
+        url = httpx.URL(
+            f"{self.endpoint}/{quote(self.bucket)}/{quote(key, safe='/-_.~')}"
+            + (f"?{query}" if query else "")
+        )
+        payload_hash = hashlib.sha256(content).hexdigest()
+        request = self.client.build_request(
+            method,
+            url,
+            content=content or None,
+            headers=self._sign(method, url, headers or {}, payload_hash),
+        )
+        return self.client.send(request, stream=stream)
+
+    def _expired(self, last_modified: datetime) -> bool:
+        return self._expires(last_modified.timestamp()) <= time.time()
+
+    def _list(self, prefix: str) -> Iterator[tuple[str, datetime]]:
+        """列出前缀下的所有对象键和修改时间"""
+        params = {"list-type": "2", "prefix": f"{self.prefix}{prefix}"}
+        while True:
+            response = self._request("GET", params=params)
+            response.raise_for_status()
+            root = ElementTree.fromstring(response.content)
+            namespace = root.tag.split("}")[0] + "}" if root.tag.startswith("{") else ""
+            for item in root.iter(f"{namespace}Contents"):
+                key = item.findtext(f"{namespace}Key", "")
+                modified = item.findtext(f"{namespace}LastModified", "")
+                yield key, datetime.fromisoformat(modified.replace("Z", "+00:00"))
+            token = root.findtext(f"{namespace}NextContinuationToken")
+            if root.findtext(f"{namespace}IsTruncated") != "true" or not token:
+                break
+            params["continuation-token"] = token
+
+    def save(self, id: str, content: bytes, suffix: str, media_type: str) -> None:
+        response = self._request(
+            "PUT",
+            f"{self.prefix}{id}",
+            content=content,
+            headers={
+                "content-type": media_type,
+                "x-amz-meta-filename": f"{id}{suffix}",
+            },
+        )
+        response.raise_for_status()
+        logger.info(f"图片已上传到: {self.bucket}/{self.prefix}{id}")
+
+    def open(self, id: str) -> StoredResult | None:
+        response = self._request("GET", f"{self.prefix}{id}", stream=True)
+        if response.status_code == 404:
+            response.close()
+            return None
+        if response.is_error:
+            response.read()
+            response.raise_for_status()
+        last_modified = response.headers.get("last-modified")
+        if last_modified and self._expired(parsedate_to_datetime(last_modified)):
+            response.close()
+            self.expired += 1
+            self.remove([id])
+            return None
+
+        def chunks() -> Iterator[bytes]:
+            try:
+                yield from response.iter_bytes(CHUNK_SIZE)
+            finally:
+                response.close()
+
+        size = response.headers.get("content-length")
+        return StoredResult(
+            response.headers.get("x-amz-meta-filename", id),
+            response.headers.get("content-type"),
+            int(size) if size else None,
+            chunks(),
+        )
+
+    def find(self, prefix: str) -> list[str]:
+        return sorted(
+            key.removeprefix(self.prefix)
+            for key, modified in self._list(prefix)
+            if not self._expired(modified)
+        )
+
+    def remove(self, ids: list[str]) -> None:
+        for id in ids:
+            try:
+                response = self._request("DELETE", f"{self.prefix}{id}")
+                response.raise_for_status()
+            except Exception as e:
+                logger.error(f"删除对象存储中的结果失败: {str(e)}")
+
+    def sweep(self) -> int:
+        if self.ttl <= 0:
+            return 0
+        expired = [
+            key.removeprefix(self.prefix)
+            for key, modified in self._list("")
+            if self._expired(modified)
+        ]
+        self.remove(expired)
+        self.expired += len(expired)
+        if expired:
+            logger.info(f"已清理 {len(expired)} 个过期结果")
+        return len(expired)
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "endpoint": self.endpoint,
+            "bucket": self.bucket,
+            "prefix": self.prefix,
+        }
+
+
+def from_env() -> ResultStore:
+    """由环境变量创建结果存储，RESULT_BACKEND 可为 local、memory 或 s3"""
+    backend = os.getenv("RESULT_BACKEND", "local")
+    options = dict(
+        ttl=float(os.getenv("RESULT_TTL", 3600)),
+        multi_download=os.getenv("RESULT_MULTI_DOWNLOAD", "").lower()
+        in ("1", "true", "yes"),
+        sweep_interval=float(os.getenv("RESULT_SWEEP_INTERVAL", 60)),
+    )
+    max_bytes = int(float(os.getenv("RESULT_MAX_MB", 1024)) * 1024 * 1024)
+    if backend == "local":
+        return LocalResultStore(
+            OUTPUT_DIR,
+            orphan_dirs=(LEGACY_INPUT_DIR,),
+            max_bytes=max_bytes,
+            **options,
+        )
+    if backend == "memory":
+        return MemoryResultStore(max_bytes=max_bytes, **options)
+    if backend == "s3":
+        return S3ResultStore(
+            endpoint=os.environ["S3_ENDPOINT"],
+            bucket=os.environ["S3_BUCKET"],
+            access_key=os.getenv("S3_ACCESS_KEY", os.getenv("AWS_ACCESS_KEY_ID", "")),
+            secret_key=os.getenv(
+                "S3_SECRET_KEY", os.getenv("AWS_SECRET_ACCESS_KEY", "")
+            ),
+            region=os.getenv("S3_REGION", "us-east-1"),
+            prefix=os.getenv("S3_PREFIX", ""),
+            **options,
+        )
+    raise ValueError(f"不支持的结果存储后端: {backend}")
+
+
+result_store = from_env()
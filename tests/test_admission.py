@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+
+import admission
+
+
+def test_image_over_max_pixels_is_rejected():
+    budget = admission.PixelBudget(budget=1000, max_pixels=100)
+
+    async def run():
+        with pytest.raises(admission.AdmissionError) as error:
+            await budget.acquire(101)
+        assert error.value.status_code == 413
+        # count 个同尺寸的图片只按单张检查上限
+        assert await budget.acquire(100, count=5) == 500
+
+    asyncio.run(run())
+    assert budget.stats()["too_large"] == 1
+
+
+def test_cost_includes_count_and_extra():
+    budget = admission.PixelBudget(budget=1000)
+
+    async def run():
+        assert await budget.acquire(100, count=3, extra=50) == 350
+        assert budget.in_use == 350
+        budget.release(350)
+        assert budget.in_use == 0
+
+    asyncio.run(run())
+
+
+def test_oversized_request_takes_the_whole_budget():
+    budget = admission.PixelBudget(budget=1000)
+
+    async def run():
+        assert await budget.acquire(5000) == 1000
+
+    asyncio.run(run())
+
+
+def test_unlimited_budget():
+    budget = admission.PixelBudget(budget=0)
+
+    async def run():
+        assert await budget.acquire(10**9) == 0
+
+    asyncio.run(run())
+    assert budget.stats()["admitted"] == 1
+
+
+def test_full_queue_is_rejected_with_429():
+    budget = admission.PixelBudget(budget=100, max_queue=1)
+
+    async def run():
+        held = await budget.acquire(100)
+        waiter = asyncio.create_task(budget.acquire(100))
+        await asyncio.sleep(0)
+        with pytest.raises(admission.AdmissionError) as error:
+            await budget.acquire(100)
+        assert error.value.status_code == 429
+        assert error.value.retry_after == 1
+        # 不限制等待的调用方不受排队数限制
+        unbounded = asyncio.create_task(budget.acquire(100, timeout=None))
+        await asyncio.sleep(0)
+        assert budget.waiting == 2
+
+        budget.release(held)
+        budget.release(await waiter)
+        budget.release(await unbounded)
+        assert budget.in_use == 0
+
+    asyncio.run(run())
+    assert budget.stats()["rejected"] == 1
+
+
+def test_wait_timeout_is_rejected_with_503():
+    budget = admission.PixelBudget(budget=100, max_wait=0.01)
+
+    async def run():
+        held = await budget.acquire(100)
+        with pytest.raises(admission.AdmissionError) as error:
+            await budget.acquire(50)
+        assert error.value.status_code == 503
+        assert budget.waiting == 0
+        budget.release(held)
+        assert budget.in_use == 0
+
+    asyncio.run(run())
+    assert budget.stats()["timeouts"] == 1
+
+
+def test_waiters_are_admitted_in_order():
+    budget = admission.PixelBudget(budget=100)
+    admitted: list[str] = []
+
+    async def run():
+        held = await budget.acquire(100)
+
+        async def wait(name: str, pixels: int):
+            cost = await budget.acquire(pixels)
+            admitted.append(name)
+            return cost
+
+        first = asyncio.create_task(wait("first", 80))
+        await asyncio.sleep(0)
+        # 后到的小请求不会越过排在前面的请求
+        second = asyncio.create_task(wait("second", 10))
+        await asyncio.sleep(0)
+        assert admitted == []
+
+        budget.release(held)
+        costs = await asyncio.gather(first, second)
+        assert budget.in_use == sum(costs) == 90
+
+    asyncio.run(run())
+    assert admitted == ["first", "second"]
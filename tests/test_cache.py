@@ -0,0 +1,65 @@
+import cache
+
+
+def detections(n: int) -> list:
+    return [((n, n, n + 10, n + 10), "head", 0.9)]
+
+
+def test_hits_and_misses():
+    detection_cache = cache.DetectionCache(max_entries=4)
+    assert detection_cache.get("a") is None
+    detection_cache.put("a", detections(1))
+    assert detection_cache.get("a") == detections(1)
+    assert detection_cache.get("a") == detections(1)
+
+    stats = detection_cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (2, 1, 1)
+
+
+def test_empty_results_are_cached():
+    detection_cache = cache.DetectionCache(max_entries=4)
+    detection_cache.put("a", [])
+    assert detection_cache.get("a") == []
+    assert detection_cache.stats()["hits"] == 1
+
+
+def test_least_recently_used_is_evicted():
+    detection_cache = cache.DetectionCache(max_entries=2)
+    detection_cache.put("a", detections(1))
+    detection_cache.put("b", detections(2))
+    # 访问 a 后 b 成为最久未使用的条目
+    detection_cache.get("a")
+    detection_cache.put("c", detections(3))
+
+    assert detection_cache.get("b") is None
+    assert detection_cache.get("a") == detections(1)
+    assert detection_cache.get("c") == detections(3)
+    assert detection_cache.stats()["evictions"] == 1
+
+
+def test_disabled_memory_layer():
+    detection_cache = cache.DetectionCache(max_entries=0)
+    detection_cache.put("a", detections(1))
+    assert detection_cache.get("a") is None
+    assert detection_cache.stats()["entries"] == 0
+
+
+def test_disk_layer(tmp_path):
+    detection_cache = cache.DetectionCache(max_entries=1, cache_dir=tmp_path)
+    detection_cache.put("a", detections(1))
+    detection_cache.put("b", detections(2))
+
+    # a 已被内存层淘汰，从磁盘读取后重新放入内存层
+    assert detection_cache.get("a") == detections(1)
+    assert detection_cache.get("a") == detections(1)
+    stats = detection_cache.stats()
+    assert (stats["disk_hits"], stats["hits"], stats["evictions"]) == (1, 1, 2)
+
+    reopened = cache.DetectionCache(max_entries=1, cache_dir=tmp_path)
+    assert reopened.get("b") == detections(2)
+
+
+def test_keys_depend_on_model():
+    digest = cache.content_digest(b"image")
+    assert cache.make_key("head@1", digest) != cache.make_key("head@2", digest)
+    assert cache.make_key("head@1", digest) == cache.make_key("head@1", digest)
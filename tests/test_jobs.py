@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+import jobs
+
+
+def check(url: str, allowed_hosts: set[str] = set()) -> None:
+    asyncio.run(jobs.check_callback_url(url, allowed_hosts))
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "http://127.0.0.1/callback",
+        "http://localhost:8000/callback",
+        "http://10.0.0.5/callback",
+        "http://172.16.0.1/callback",
+        "http://192.168.1.1/callback",
+        "http://169.254.169.254/latest/meta-data/",
+        "http://0.0.0.0/callback",
+        "http://[::1]/callback",
+        "http://[fd00::1]/callback",
+        "http://[fe80::1]/callback",
+        "http://[::ffff:127.0.0.1]/callback",
+        "http://[::ffff:10.0.0.5]/callback",
+        "http://[::ffff:169.254.169.254]/callback",
+    ],
+)
+def test_internal_addresses_are_rejected(url: str):
+    with pytest.raises(jobs.CallbackError):
+        check(url)
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "http://8.8.8.8/callback",
+        "https://1.1.1.1:8443/callback",
+        "http://[::ffff:8.8.8.8]/",
+    ],
+)
+def test_public_addresses_are_allowed(url: str):
+    check(url)
+
+
+@pytest.mark.parametrize(
+    "url", ["ftp://8.8.8.8/callback", "file:///etc/passwd", "callback", "http://"]
+)
+def test_invalid_urls_are_rejected(url: str):
+    with pytest.raises(jobs.CallbackError):
+        check(url)
+
+
+def test_allowed_hosts():
+    # 允许列表中的主机不再检查地址，其他主机即使是公网地址也被拒绝
+    check("http://127.0.0.1:9000/callback", {"127.0.0.1"})
+    with pytest.raises(jobs.CallbackError):
+        check("http://8.8.8.8/callback", {"127.0.0.1"})
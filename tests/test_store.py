@@ -0,0 +1,198 @@
+import hashlib
+import os
+from datetime import UTC, datetime, timedelta
+from email.utils import format_datetime
+from urllib.parse import unquote
+from xml.sax.saxutils import escape
+
+import httpx
+import pytest
+
+# 导入 store 时会按环境变量创建全局存储，避免在仓库目录下创建 output
+os.environ.setdefault("RESULT_BACKEND", "memory")
+
+import store  # noqa: E402
+
+NAMESPACE = "http://s3.amazonaws.com/doc/2006-03-01/"
+
+
+class FakeS3:
+    """只实现 S3ResultStore 用到的接口的内存对象存储 (路径风格地址)"""
+
+    def __init__(self, bucket: str = "results", page_size: int = 2):
+        self.bucket = bucket
+        self.page_size = page_size
+        self.objects: dict[str, tuple[bytes, dict[str, str], datetime]] = {}
+        self.requests: list[httpx.Request] = []
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handle)
+
+    def age(self, key: str, seconds: float) -> None:
+        content, headers, modified = self.objects[key]
+        self.objects[key] = (content, headers, modified - timedelta(seconds=seconds))
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        content = request.read()
+        authorization = request.headers.get("authorization", "")
+        if not authorization.startswith("AWS4-HMAC-SHA256 Credential=key/"):
+            return httpx.Response(403)
+        if (
+            request.headers["x-amz-content-sha256"]
+            != hashlib.sha256(content).hexdigest()
+        ):
+            return httpx.Response(400)
+
+        bucket, _, key = unquote(request.url.path).lstrip("/").partition("/")
+        if bucket != self.bucket:
+            return httpx.Response(404)
+        if request.method == "GET" and not key:
+            return self.list(request.url.params)
+        if request.method == "PUT":
+            headers = {
+                name: value
+                for name, value in request.headers.items()
+                if name == "content-type" or name.startswith("x-amz-meta-")
+            }
+            self.objects[key] = (content, headers, datetime.now(UTC))
+            return httpx.Response(200)
+        if request.method == "DELETE":
+            self.objects.pop(key, None)
+            return httpx.Response(204)
+        if request.method == "GET":
+            if key not in self.objects:
+                return httpx.Response(404)
+            content, headers, modified = self.objects[key]
+            return httpx.Response(
+                200,
+                content=content,
+                headers={
+                    **headers,
+                    "last-modified": format_datetime(modified, usegmt=True),
+                },
+            )
+        return httpx.Response(405)
+
+    def list(self, params: httpx.QueryParams) -> httpx.Response:
+        assert params["list-type"] == "2"
+        keys = sorted(key for key in self.objects if key.startswith(params["prefix"]))
+        start = int(params.get("continuation-token", 0))
+        page = keys[start : start + self.page_size]
+        truncated = start + self.page_size < len(keys)
+        items = "".join(
+            f"<Contents><Key>{escape(key)}</Key><LastModified>"
+            f"{self.objects[key][2].strftime('%Y-%m-%dT%H:%M:%S.000Z')}"
+            "</LastModified></Contents>"
+            for key in page
+        )
+        token = (
+            f"<NextContinuationToken>{start + self.page_size}</NextContinuationToken>"
+            if truncated
+            else ""
+        )
+        body = (
+            f'<ListBucketResult xmlns="{NAMESPACE}">{items}'
+            f"<IsTruncated>{'true' if truncated else 'false'}</IsTruncated>{token}"
+            "</ListBucketResult>"
+        )
+        return httpx.Response(200, content=body.encode())
+
+
+@pytest.fixture
+def s3() -> FakeS3:
+    return FakeS3()
+
+
+def make_store(s3: FakeS3, **kwargs) -> store.S3ResultStore:
+    return store.S3ResultStore(
+        endpoint="http://minio:9000/",
+        bucket=s3.bucket,
+        access_key="key",
+        secret_key="secret",
+        prefix="cut/",
+        transport=s3.transport(),
+        **kwargs,
+    )
+
+
+def read(result: store.StoredResult) -> bytes:
+    return b"".join(result.chunks)
+
+
+def test_save_and_open(s3: FakeS3):
+    results = make_store(s3)
+    content = os.urandom(store.CHUNK_SIZE * 2 + 10)
+    results.save("abc_head_0", content, ".png", "image/png")
+
+    assert "cut/abc_head_0" in s3.objects
+    result = results.open("abc_head_0")
+    assert result is not None
+    assert result.name == "abc_head_0.png"
+    assert result.media_type == "image/png"
+    assert result.size == len(content)
+    assert read(result) == content
+
+
+def test_open_missing(s3: FakeS3):
+    assert make_store(s3).open("missing") is None
+
+
+def test_find_follows_pagination(s3: FakeS3):
+    results = make_store(s3)
+    for index in range(5):
+        results.save(f"batch_{index}_head", b"x", ".png", "image/png")
+    results.save("other_0_head", b"x", ".png", "image/png")
+
+    assert results.find("batch_") == [f"batch_{index}_head" for index in range(5)]
+    list_requests = [r for r in s3.requests if "list-type" in r.url.params]
+    assert len(list_requests) == 3
+
+
+def test_remove_and_downloaded(s3: FakeS3):
+    results = make_store(s3)
+    results.save("a_0", b"a", ".png", "image/png")
+    results.save("a_1", b"b", ".png", "image/png")
+
+    results.remove(["a_0", "missing"])
+    assert results.find("a_") == ["a_1"]
+
+    results.downloaded(["a_1"])
+    assert results.find("a_") == []
+
+
+def test_multi_download_keeps_results(s3: FakeS3):
+    results = make_store(s3, multi_download=True)
+    results.save("a_0", b"a", ".png", "image/png")
+    results.downloaded(["a_0"])
+    assert read(results.open("a_0")) == b"a"
+
+
+def test_expired_results(s3: FakeS3):
+    results = make_store(s3, ttl=60)
+    results.save("old_0", b"a", ".png", "image/png")
+    results.save("old_1", b"b", ".png", "image/png")
+    results.save("new_0", b"c", ".png", "image/png")
+    s3.age("cut/old_0", 120)
+    s3.age("cut/old_1", 120)
+
+    assert results.find("old_") == []
+    assert results.open("old_0") is None
+    assert "cut/old_0" not in s3.objects
+
+    assert results.sweep() == 1
+    assert sorted(s3.objects) == ["cut/new_0"]
+    assert results.stats()["expired"] == 2
+
+
+def test_requests_are_signed(s3: FakeS3):
+    make_store(s3).save("a_0", b"a", ".png", "image/png")
+    request = s3.requests[-1]
+    assert request.url.path == "/results/cut/a_0"
+    signed = request.headers["authorization"].split("SignedHeaders=")[1]
+    assert "host" in signed and "x-amz-date" in signed
+
+
+def test_result_store_is_abstract():
+    with pytest.raises(TypeError):
+        store.ResultStore()
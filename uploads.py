@@ -0,0 +1,264 @@
+import io
+import os
+import zipfile
+from collections.abc import Collection
+
+from fastapi import HTTPException
+from PIL import Image
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.datastructures import Headers
+
+import admission
+
+# 请求体大小上限 (字节)，0 表示不限制
+MAX_UPLOAD_BYTES = int(float(os.getenv("MAX_UPLOAD_MB", 50)) * 1024 * 1024)
+# /cutbatch 等批量接口的请求体大小上限
+MAX_BATCH_UPLOAD_BYTES = int(
+    float(os.getenv("MAX_BATCH_UPLOAD_MB", 1024)) * 1024 * 1024
+)
+# 单个 zip 压缩包解压后的总大小上限
+MAX_ARCHIVE_BYTES = int(float(os.getenv("MAX_ARCHIVE_MB", 1024)) * 1024 * 1024)
+# 识别文件格式需要的文件头字节数
+MAGIC_BYTES = 16
+# 读取图片尺寸时最多缓存的文件头字节数，超过后交给接口处理
+MAX_HEADER_BYTES = 256 * 1024
+# 可以识别的视频容器格式
+VIDEO_FORMATS = {"mp4", "webm", "avi"}
+# 魔数表之外、由 Pillow 识别后放行的图片格式
+PIL_FORMATS = {"ICO", "TGA", "PPM", "PSD", "JPEG2000", "QOI", "DDS", "PCX", "SGI"}
+
+
+def sniff_format(head: bytes) -> str | None:
+    """根据文件头的魔数识别文件格式，无法识别时返回 None"""
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[:2] == b"BM":
+        return "bmp"
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return "tiff"
+    if head[4:8] == b"ftyp":
+        return "avif" if head[8:12] in (b"avif", b"avis") else "mp4"
+    if head[:4] == b"\x1aE\xdf\xa3":
+        return "webm"
+    if head[:4] == b"RIFF" and head[8:12] == b"AVI ":
+        return "avi"
+    if head[:4] == b"PK\x03\x04":
+        return "zip"
+    return None
+
+
+def check_image_header(
+    head: bytes, complete: bool = False, allow_video: bool = False
+) -> bool:
+    """校验图片文件头，格式不支持时返回 400，尺寸超过上限时返回 413
+
+    ``allow_video`` 为 True 时也接受视频，视频只校验格式。魔数表无法识别的
+    文件交给 Pillow 识别，只接受 ``PIL_FORMATS`` 中的格式。
+
+    Returns:
+        是否已完成校验；文件头不足以判断时返回 False
+    """
+    if len(head) < MAGIC_BYTES and not complete:
+        return False
+    format = sniff_format(head)
+    if format in VIDEO_FORMATS and allow_video:
+        return True
+    if format == "zip" or format in VIDEO_FORMATS:
+        raise HTTPException(status_code=400, detail="文件类型不支持")
+    try:
+        with Image.open(io.BytesIO(head)) as image:
+            if format is None and image.format not in PIL_FORMATS:
+                raise HTTPException(status_code=400, detail="文件类型不支持")
+            width, height = image.size
+    except HTTPException:
+        raise
+    except Image.DecompressionBombError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception:
+        # 尺寸信息还未到达 (如 JPEG 的 EXIF 较大)；魔数表之外的格式必须由
+        # Pillow 识别，完整的文件头仍无法识别时拒绝
+        done = complete or len(head) >= MAX_HEADER_BYTES
+        if format is None and done:
+            raise HTTPException(status_code=400, detail="文件类型不支持")
+        return done
+    try:
+        admission.pixel_budget.check(width * height)
+    except admission.AdmissionError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    return True
+
+
+def archive_members(archive: zipfile.ZipFile) -> list[zipfile.ZipInfo]:
+    """zip 压缩包中的文件，解压后的总大小超过上限时返回 413"""
+    members = [
+        info
+        for info in archive.infolist()
+        if not info.is_dir() and not info.filename.startswith("__MACOSX/")
+    ]
+    total = sum(info.file_size for info in members)
+    if MAX_ARCHIVE_BYTES > 0 and total > MAX_ARCHIVE_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"压缩包解压后超过上限 {MAX_ARCHIVE_BYTES / 1024 / 1024:g}MB",
+        )
+    return members
+
+
+def read_archive_member(archive: zipfile.ZipFile, info: zipfile.ZipInfo) -> bytes:
+    """读取 zip 压缩包中的图片
+
+    先按声明的解压大小限制，再校验文件头，通过后才解压全部内容；解压读取的
+    字节数不会超过声明的大小。
+    """
+    if MAX_UPLOAD_BYTES > 0 and info.file_size > MAX_UPLOAD_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"文件解压后超过上限 {MAX_UPLOAD_BYTES / 1024 / 1024:g}MB",
+        )
+    with archive.open(info) as member:
+        head = member.read(MAX_HEADER_BYTES)
+        if not head:
+            return b""
+        check_image_header(head, complete=True)
+        return head + member.read()
+
+
+class _PartInspector:
+    """随请求体流式解析 multipart，在每个文件的文件头到达时立即校验"""
+
+    def __init__(self, boundary: bytes, allow_video: bool = False):
+        self.allow_video = allow_video
+        self._head = bytearray()
+        self._is_file = False
+        self._checked = False
+        self._header_field = b""
+        self._header_value = b""
+        self._parser = MultipartParser(
+            boundary,
+            callbacks={
+                "on_part_begin": self._on_part_begin,
+                "on_header_field": self._on_header_field,
+                "on_header_value": self._on_header_value,
+                "on_header_end": self._on_header_end,
+                "on_part_data": self._on_part_data,
+                "on_part_end": self._on_part_end,
+            },
+        )
+
+    def feed(self, data: bytes) -> None:
+        if data:
+            self._parser.write(data)
+
+    def _on_part_begin(self) -> None:
+        self._head.clear()
+        self._is_file = False
+        self._checked = False
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        if self._header_field.lower() == b"content-disposition":
+            _, options = parse_options_header(self._header_value)
+            self._is_file = b"filename" in options
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if not self._is_file or self._checked:
+            return
+        self._head += data[start : min(end, start + MAX_HEADER_BYTES - len(self._head))]
+        self._checked = check_image_header(
+            bytes(self._head), allow_video=self.allow_video
+        )
+
+    def _on_part_end(self) -> None:
+        # 空文件由接口报告
+        if self._is_file and self._head and not self._checked:
+            self._checked = check_image_header(
+                bytes(self._head), complete=True, allow_video=self.allow_video
+            )
+
+
+class UploadGuardMiddleware:
+    """在读取请求体的同时限制大小并校验上传的图片
+
+    ``Content-Length`` 超过上限的请求在读取请求体之前拒绝，分块上传在累计
+    超过上限时拒绝 (413)。单图接口中每个文件的格式和尺寸在其文件头到达时
+    即校验，无需等待整个请求体。``batch_paths`` 中的批量接口只限制大小，
+    逐个文件的错误由接口按行返回，``video_paths`` 中的接口还接受视频。
+    错误在接口读取请求体时抛出，因此鉴权
+    失败等不读取请求体的请求不受影响。通过校验的文件仍由 Starlette 缓存到
+    SpooledTemporaryFile，接口解码前会把整个文件读入内存，这里只负责提前拒绝。
+    """
+
+    def __init__(
+        self,
+        app,
+        max_bytes: int = MAX_UPLOAD_BYTES,
+        batch_max_bytes: int = MAX_BATCH_UPLOAD_BYTES,
+        batch_paths: Collection[str] = (),
+        video_paths: Collection[str] = (),
+    ):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.batch_max_bytes = batch_max_bytes
+        self.batch_paths = batch_paths
+        self.video_paths = video_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("POST", "PUT"):
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        batch = scope["path"] in self.batch_paths
+        limit = self.batch_max_bytes if batch else self.max_bytes
+        try:
+            declared = int(headers.get("content-length", ""))
+        except ValueError:
+            declared = None
+        inspector = None
+        content_type, options = parse_options_header(headers.get("content-type", ""))
+        if (
+            not batch
+            and content_type == b"multipart/form-data"
+            and b"boundary" in options
+        ):
+            inspector = _PartInspector(
+                options[b"boundary"], allow_video=scope["path"] in self.video_paths
+            )
+        received = 0
+        too_large = HTTPException(
+            status_code=413, detail=f"请求体超过上限 {limit / 1024 / 1024:g}MB"
+        )
+
+        async def guarded_receive():
+            nonlocal received, inspector
+            if limit > 0 and declared is not None and declared > limit:
+                raise too_large
+            message = await receive()
+            if message["type"] == "http.request":
+                body = message.get("body", b"")
+                received += len(body)
+                if limit > 0 and received > limit:
+                    raise too_large
+                if inspector is not None:
+                    try:
+                        inspector.feed(body)
+                    except HTTPException:
+                        raise
+                    except Exception:
+                        # 格式错误的请求体交给接口自己的解析器报告
+                        inspector = None
+            return message
+
+        await self.app(scope, guarded_receive, send)
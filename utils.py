@@ -1,5 +1,119 @@
+import io
+import zipfile
+from collections.abc import Iterable, Iterator
 from pathlib import Path
 from loguru import logger
+from PIL import Image
+
+import cache
+import metrics
+
+
+def open_image(content: bytes) -> Image.Image:
+    """打开上传的图片 (只解析文件头，像素在首次使用时才解码)，并记录内容哈希供检测缓存使用"""
+    image = Image.open(io.BytesIO(content))
+    image.info["digest"] = cache.content_digest(content)
+    return image
+
+
+def image_size(content: bytes) -> tuple[int, int]:
+    """只解析文件头读取图片尺寸，不解码像素"""
+    with Image.open(io.BytesIO(content)) as image:
+        return image.size
+
+
+def load_image(
+    content: bytes, max_detect_side: int = 0
+) -> tuple[Image.Image, Image.Image, tuple[float, float]]:
+    """打开图片并准备检测用图
+
+    图片长边超过 ``max_detect_side`` 时，检测在缩小的代理图上进行。JPEG 使用
+    draft 模式直接按比例解码代理图，原图保持延迟解码，直到真正需要裁剪或绘制；
+    其他格式只完整解码一次，代理图由解码后的原图缩小得到。
+
+    Returns:
+        (原图, 检测用图, 检测框到原图坐标的缩放比例 (x, y))
+    """
+    with metrics.stage("decode"):
+        image = open_image(content)
+        width, height = image.size
+        if max_detect_side <= 0 or max(width, height) <= max_detect_side:
+            image.load()
+            return image, image, (1.0, 1.0)
+
+        ratio = max_detect_side / max(width, height)
+        target = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+        if image.format == "JPEG":
+            proxy = Image.open(io.BytesIO(content))
+            proxy.draft("RGB", target)
+            proxy.thumbnail(target)
+        else:
+            image.load()
+            # 与 thumbnail 相同的缩放方式，但不修改原图
+            proxy = image.resize(target, Image.Resampling.BICUBIC, reducing_gap=2.0)
+        proxy.info["digest"] = f"{image.info['digest']}@{max_detect_side}"
+        return image, proxy, (width / proxy.width, height / proxy.height)
+
+
+class _ZipSink(io.RawIOBase):
+    """只写的缓冲区，供 zipfile 以流式方式写出压缩包"""
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(files: Iterable[tuple[str, Iterable[bytes]]]) -> Iterator[bytes]:
+    """边读取文件边生成 zip 数据块，不在内存或磁盘上缓存整个压缩包
+
+    Args:
+        files: (压缩包内的文件名, 文件内容的数据块) 序列
+    """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED) as archive:
+        for name, chunks in files:
+            with archive.open(name, "w", force_zip64=True) as target:
+                for chunk in chunks:
+                    target.write(chunk)
+                    if data := sink.drain():
+                        yield data
+            if data := sink.drain():
+                yield data
+    if data := sink.drain():
+        yield data
+
+
+def limit_onnx_threads(intra_op_threads: int) -> None:
+    """限制之后创建的 ONNX 会话的 intra-op 线程数
+
+    imgutils 创建会话时会把 intra_op_num_threads 设为 CPU 核数，
+    这里包装其使用的 InferenceSession，在创建时覆盖该设置。
+    """
+    from imgutils.utils import onnxruntime as imgutils_onnx
+
+    session_cls = getattr(
+        imgutils_onnx.InferenceSession, "__wrapped__", imgutils_onnx.InferenceSession
+    )
+
+    def create_session(path, sess_options=None, *args, **kwargs):
+        if sess_options is not None:
+            sess_options.intra_op_num_threads = intra_op_threads
+            sess_options.inter_op_num_threads = 1
+        return session_cls(path, sess_options, *args, **kwargs)
+
+    create_session.__wrapped__ = session_cls
+    imgutils_onnx.InferenceSession = create_session
 
 
 def cleanup_temp_file(files: list[Path]) -> None:
@@ -0,0 +1,399 @@
+import dataclasses
+import heapq
+import io
+import os
+import tempfile
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+
+import numpy as np
+from loguru import logger
+from PIL import Image
+
+import detect
+import gen
+import geometry
+import metrics
+import uploads
+
+# 每个片段最多处理的采样帧数
+CLIP_MAX_FRAMES = int(os.getenv("CLIP_MAX_FRAMES", 300))
+# 每个片段最多输出的跟踪对象数
+CLIP_MAX_TRACKS = int(os.getenv("CLIP_MAX_TRACKS", 8))
+# 每个片段同时缓存的裁剪帧像素总数上限 (百万像素)
+CLIP_MAX_CROP_PIXELS = int(float(os.getenv("CLIP_MAX_CROP_MP", 100)) * 1_000_000)
+# 输出裁剪的最大边长
+CLIP_MAX_SIZE = 1024
+# 裁剪窗口的平滑系数 (越小越稳定，1 表示不平滑)
+WINDOW_SMOOTHING = 0.4
+
+
+class Clip:
+    """动图 (GIF/WebP/APNG) 或视频片段，逐帧流式解码
+
+    视频内容写入临时文件后由 OpenCV 读取，使用完毕需调用 ``close``。
+    """
+
+    def __init__(self, content: bytes):
+        self._path: str | None = None
+        self._image: Image.Image | None = None
+        format = uploads.sniff_format(content[: uploads.MAGIC_BYTES])
+        if format in uploads.VIDEO_FORMATS:
+            import cv2
+
+            file = tempfile.NamedTemporaryFile(suffix=f".{format}", delete=False)
+            self._path = file.name
+            try:
+                with file:
+                    file.write(content)
+                capture = cv2.VideoCapture(self._path)
+                try:
+                    if not capture.isOpened():
+                        raise ValueError("无法读取视频")
+                    self.width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+                    self.height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                    self.source_fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+                finally:
+                    capture.release()
+            except BaseException:
+                # 打开失败时调用方拿不到对象，临时文件需在此删除
+                self.close()
+                raise
+        else:
+            self._image = Image.open(io.BytesIO(content))
+            self.width, self.height = self._image.size
+            duration = self._image.info.get("duration") or 100
+            self.source_fps = 1000 / duration
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return self.width, self.height
+
+    def frames(self, fps: float, max_frames: int) -> Iterator[Image.Image]:
+        """按 ``fps`` 采样逐帧产出 RGB 图片，同一时刻只保留当前帧"""
+        interval = 1 / fps
+        next_time = 0.0
+        count = 0
+        for time, read in self._timeline():
+            if time + 1e-6 < next_time:
+                continue
+            with metrics.stage("decode"):
+                frame = read()
+            if frame is None:
+                break
+            yield frame
+            count += 1
+            if count >= max_frames:
+                break
+            while next_time <= time + 1e-6:
+                next_time += interval
+
+    def _timeline(self):
+        """依次产出 (帧时间, 读取该帧的函数)，跳过的帧不做颜色转换"""
+        if self._image is not None:
+            time = 0.0
+            for index in range(getattr(self._image, "n_frames", 1)):
+                self._image.seek(index)
+                yield time, lambda: self._image.convert("RGB")
+                time += (self._image.info.get("duration") or 100) / 1000
+            return
+
+        import cv2
+
+        capture = cv2.VideoCapture(self._path)
+        try:
+            index = 0
+            while capture.grab():
+
+                def read():
+                    ok, frame = capture.retrieve()
+                    if not ok:
+                        return None
+                    return Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+                yield index / self.source_fps, read
+                index += 1
+        finally:
+            capture.release()
+
+    def close(self) -> None:
+        """释放解码器并删除临时文件，可重复调用"""
+        if self._image is not None:
+            self._image.close()
+            self._image = None
+        if self._path is not None:
+            path, self._path = self._path, None
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self) -> "Clip":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+@dataclass
+class Track:
+    """在关键帧之间延续的对象"""
+
+    id: int
+    box: np.ndarray
+    # 最近一次匹配的检测置信度和历史最高置信度
+    score: float
+    peak: float
+    hits: int = 1
+    missed: int = 0
+    # 平滑后的裁剪窗口 (中心 x, 中心 y, 边长)
+    window: np.ndarray | None = None
+    frames: list[Image.Image] = field(default_factory=list, repr=False)
+    best: tuple[float, Image.Image] | None = field(default=None, repr=False)
+    # 裁剪帧缓存达到上限后不再追加，动画在此处结束
+    truncated: bool = False
+
+
+class BoxTracker:
+    """按 IoU 贪心匹配关键帧检测结果，连续 ``max_missed`` 个关键帧未匹配的对象结束跟踪"""
+
+    def __init__(self, iou_threshold: float = 0.3, max_missed: int = 2):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.tracks: dict[int, Track] = {}
+        self._next_id = 0
+
+    def update(self, detections: list[detect.Detection]) -> dict[int, np.ndarray]:
+        """匹配新关键帧的检测结果，返回本关键帧中可见对象的 {id: 检测框}"""
+        active = [
+            track for track in self.tracks.values() if track.missed <= self.max_missed
+        ]
+        boxes = geometry.boxes_of(detections)
+        matched: dict[int, np.ndarray] = {}
+        used: set[int] = set()
+        if active and len(boxes):
+            overlaps = geometry.iou(np.array([track.box for track in active]), boxes)
+            # 按重叠度从高到低贪心匹配
+            for flat in np.argsort(overlaps, axis=None)[::-1]:
+                t, d = divmod(int(flat), len(boxes))
+                if overlaps[t, d] < self.iou_threshold:
+                    break
+                track = active[t]
+                if track.id in matched or d in used:
+                    continue
+                track.box = boxes[d]
+                track.score = detections[d][2]
+                track.peak = max(track.peak, track.score)
+                track.hits += 1
+                track.missed = 0
+                matched[track.id] = boxes[d]
+                used.add(d)
+        for track in active:
+            if track.id not in matched:
+                track.missed += 1
+        for d, (_, _, score) in enumerate(detections):
+            if d in used:
+                continue
+            track = Track(id=self._next_id, box=boxes[d], score=score, peak=score)
+            self.tracks[track.id] = track
+            matched[track.id] = boxes[d]
+            self._next_id += 1
+        return matched
+
+    def expire(self) -> list[Track]:
+        """移除连续 ``max_missed`` 个关键帧以上未匹配的对象并返回它们"""
+        expired = [
+            track for track in self.tracks.values() if track.missed > self.max_missed
+        ]
+        for track in expired:
+            del self.tracks[track.id]
+        return expired
+
+
+def _smooth_window(
+    track: Track, box: np.ndarray, size: tuple[int, int], padding_ratio: float
+) -> tuple[int, int, int, int]:
+    """以对象为中心的正方形窗口，中心和边长在帧间平滑，贴边时平移而不缩小"""
+    width, height = size
+    x0, y0, x1, y1 = box
+    target = np.array(
+        [(x0 + x1) / 2, (y0 + y1) / 2, max(x1 - x0, y1 - y0) * (1 + padding_ratio * 2)]
+    )
+    if track.window is None:
+        track.window = target
+    else:
+        track.window = track.window + WINDOW_SMOOTHING * (target - track.window)
+    center_x, center_y, side = track.window
+    side = int(max(1, min(side, width, height)))
+    left = int(min(max(0, round(center_x - side / 2)), width - side))
+    top = int(min(max(0, round(center_y - side / 2)), height - side))
+    return left, top, left + side, top + side
+
+
+def animation_encoding(encoding: gen.Encoding) -> gen.Encoding:
+    """动画输出的编码设置，JPEG 不支持动画时改用 WebP"""
+    if encoding.format == "jpeg":
+        return dataclasses.replace(encoding, format="webp")
+    return encoding
+
+
+def encode_animation(
+    frames: list[Image.Image], duration: int, encoding: gen.Encoding
+) -> bytes:
+    """把多帧图片编码为动画 (APNG/WebP/AVIF)"""
+    if len(frames) == 1:
+        return gen.encode(frames[0], encoding)
+    return gen.encode(
+        frames[0],
+        encoding,
+        save_all=True,
+        append_images=frames[1:],
+        duration=duration,
+        loop=0,
+    )
+
+
+def crop_budget(
+    target_size: int,
+    max_frames: int = CLIP_MAX_FRAMES,
+    max_tracks: int = CLIP_MAX_TRACKS,
+    animate: bool = True,
+) -> int:
+    """跟踪过程中同时缓存的裁剪帧像素数上限"""
+    frames = max_frames if animate else 1
+    return min(CLIP_MAX_CROP_PIXELS, frames * max_tracks * target_size**2)
+
+
+def track_squares(
+    type: gen.GenSquareType,
+    clip: Clip,
+    target_size: int = 512,
+    padding_ratio: float = 0.3,
+    fps: float = 10,
+    keyframe_interval: int = 5,
+    max_frames: int = CLIP_MAX_FRAMES,
+    max_tracks: int = CLIP_MAX_TRACKS,
+    animate: bool = True,
+    encoding: gen.Encoding = gen.PNG,
+) -> list[bytes] | None:
+    """
+    在动图或视频中跟踪对象并为每个对象生成稳定的正方形裁剪
+
+    只在每 ``keyframe_interval`` 个采样帧中的关键帧上运行检测，关键帧之间的
+    检测框线性插值，短暂丢失的对象沿用上一次的位置。帧按流水线处理，缓存的
+    原始帧不超过一个关键帧间隔；对象结束跟踪时立即编码并释放其裁剪帧，误检
+    直接丢弃，每个关键帧只跟踪置信度最高的 ``max_tracks`` 个检测结果。
+    缓存的裁剪帧总像素数不超过 ``crop_budget``，达到上限的对象不再追加帧，
+    其动画提前结束。
+
+    Args:
+        clip: 输入片段
+        fps: 采样帧率
+        keyframe_interval: 相邻两次检测之间的采样帧数
+        max_frames: 最多处理的采样帧数
+        max_tracks: 最多输出的对象数 (按检测置信度)
+        animate: 为 True 时输出每个对象的裁剪动画，否则输出置信度最高的关键帧裁剪
+        encoding: 输出图片的编码设置
+
+    Returns:
+        list[bytes] | None: 每个对象一个裁剪结果，未检测到对象时返回 None
+    """
+    tracker = BoxTracker()
+    previous: dict[int, np.ndarray] = {}
+    pending: list[Image.Image] = []
+    if animate:
+        encoding = animation_encoding(encoding)
+    # 已结束的对象的编码结果 (最高置信度, id, 输出)，只保留置信度最高的 max_tracks 个
+    finished: list[tuple[float, int, bytes]] = []
+    crop_pixels = target_size * target_size
+    max_buffered = crop_budget(target_size, max_frames, max_tracks, animate)
+    buffered = 0
+
+    def render(frame: Image.Image, track: Track, box: np.ndarray, score: float | None):
+        nonlocal buffered
+        window = _smooth_window(track, box, frame.size, padding_ratio)
+        if animate:
+            if track.truncated:
+                return
+        elif score is None or (track.best is not None and score <= track.best[0]):
+            return
+        # 替换已有的最佳帧不增加缓存，新增裁剪帧前检查缓存上限
+        grows = animate or track.best is None
+        if grows and buffered + crop_pixels > max_buffered:
+            track.truncated = True
+            return
+        with metrics.stage("crop"):
+            crop = frame.crop(window).resize(
+                (target_size, target_size), Image.Resampling.LANCZOS
+            )
+        if grows:
+            buffered += crop_pixels
+        if animate:
+            track.frames.append(crop)
+        else:
+            track.best = (score, crop)
+
+    def flush(current: dict[int, np.ndarray] | None):
+        # 插值输出上一个关键帧之后缓存的中间帧
+        steps = len(pending) + 1
+        for offset, frame in enumerate(pending, 1):
+            for id, start in previous.items():
+                end = current.get(id) if current is not None else None
+                box = start if end is None else start + (end - start) * offset / steps
+                render(frame, tracker.tracks[id], box, None)
+        pending.clear()
+
+    def finish(track: Track, min_hits: int):
+        nonlocal buffered
+        # 对象结束后立即编码并释放裁剪帧，只出现在单个关键帧中的对象视为误检
+        if track.hits >= min_hits and (animate and track.frames or track.best):
+            if len(finished) < max_tracks or track.peak > finished[0][0]:
+                if animate:
+                    output = encode_animation(track.frames, round(1000 / fps), encoding)
+                else:
+                    output = gen.encode(track.best[1], encoding)
+                heapq.heappush(finished, (track.peak, track.id, output))
+                if len(finished) > max_tracks:
+                    heapq.heappop(finished)
+        buffered -= (len(track.frames) + (track.best is not None)) * crop_pixels
+        track.frames = []
+        track.best = None
+
+    keyframes = 0
+    for index, frame in enumerate(clip.frames(fps, max_frames)):
+        if index % keyframe_interval:
+            pending.append(frame)
+            continue
+        keyframes += 1
+        # 相邻关键帧画面相近，不能复用彼此的检测结果，且视频帧不会再次出现，
+        # 不写入检测缓存；只跟踪置信度最高的
+        # max_tracks 个检测结果，限制同时缓存裁剪帧的对象数
+        detections = gen.detect_objects(
+            type, frame, near_duplicates=False, use_cache=False
+        )
+        current = tracker.update(
+            geometry.select(detections, max_objects=max_tracks) or []
+        )
+        flush(current)
+        for track in tracker.expire():
+            # 对象结束时至少已有两个关键帧
+            finish(track, 2)
+        # 本关键帧未匹配但仍在跟踪的对象沿用上一次的位置
+        previous = {
+            **{id: box for id, box in previous.items() if id in tracker.tracks},
+            **current,
+        }
+        for id, box in previous.items():
+            track = tracker.tracks[id]
+            render(frame, track, box, track.score if id in current else None)
+    flush(None)
+    min_hits = min(2, keyframes)
+    for track in list(tracker.tracks.values()):
+        finish(track, min_hits)
+
+    if not finished:
+        logger.error("未检测到任何对象")
+        return None
+    outputs = [output for _, _, output in sorted(finished, key=lambda item: item[1])]
+    logger.info(f"已跟踪 {keyframes} 个关键帧，生成 {len(outputs)} 个对象的裁剪")
+    return outputs
@@ -0,0 +1,113 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from loguru import logger
+
+import gen
+import metrics
+import utils
+
+
+def _init_worker(preload: list[str], onnx_threads: int) -> None:
+    """工作进程启动时限制 ONNX 线程数并预加载模型"""
+    if onnx_threads > 0:
+        utils.limit_onnx_threads(onnx_threads)
+    try:
+        gen.warm_up([gen.GenSquareType(name) for name in preload])
+    except Exception as e:
+        logger.error(f"工作进程 {os.getpid()} 预加载模型失败: {str(e)}")
+    logger.info(f"工作进程 {os.getpid()} 已就绪")
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _run(kind: str, shm_name: str, size: int, kwargs: dict):
+    """在工作进程中从共享内存读取图片并执行生成函数，同时返回各阶段耗时"""
+    shm = shared_memory.SharedMemory(name=shm_name, track=False)
+    try:
+        content = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+    with metrics.collect() as trace:
+        image, detect_image, scale = utils.load_image(content, gen.MAX_DETECT_SIDE)
+        type = kwargs["type"]
+        results = gen.scale_results(
+            gen.detect_objects(type, detect_image), scale, image.size
+        )
+        output = gen.generators[kind](image=image, results=results or [], **kwargs)
+    return output, trace
+
+
+class WorkerPool:
+    """进程池执行模式，每个工作进程在启动时加载一次模型"""
+
+    def __init__(self, workers: int, onnx_threads: int, preload: list[str]):
+        self.workers = workers
+        self.onnx_threads = onnx_threads
+        self.preload = preload
+        self._executor: ProcessPoolExecutor | None = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.preload, self.onnx_threads),
+            )
+        return self._executor
+
+    async def start(self) -> None:
+        """启动全部工作进程并等待模型加载完成"""
+        loop = asyncio.get_running_loop()
+        pids = await asyncio.gather(
+            *(loop.run_in_executor(self.executor, _ping) for _ in range(self.workers))
+        )
+        logger.info(f"已启动 {len(set(pids))} 个工作进程")
+
+    async def run(self, kind: str, content: bytes, **kwargs):
+        """通过共享内存把图片交给工作进程处理"""
+        shm = shared_memory.SharedMemory(create=True, size=max(len(content), 1))
+        try:
+            shm.buf[: len(content)] = content
+            output, trace = await asyncio.get_running_loop().run_in_executor(
+                self.executor, _run, kind, shm.name, len(content), kwargs
+            )
+            metrics.merge(trace)
+            return output
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def from_env() -> WorkerPool | None:
+    """由环境变量创建进程池，WORKER_PROCESSES 为 0 时不启用"""
+    workers = int(os.getenv("WORKER_PROCESSES", 0))
+    if workers <= 0:
+        return None
+    return WorkerPool(
+        workers=workers,
+        onnx_threads=int(
+            os.getenv("WORKER_ONNX_THREADS", max(1, (os.cpu_count() or 1) // workers))
+        ),
+        preload=[
+            name.strip()
+            for name in os.getenv(
+                "WORKER_PRELOAD", os.getenv("WARMUP_TYPES", "head")
+            ).split(",")
+            if name.strip()
+        ],
+    )
+
+
+process_pool = from_env()